@@ -0,0 +1,827 @@
+# Copyright (c) 2017 David Preece, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+# Benchmarks that run without a location - the location is replaced with a local stand-in
+# python3 tf_bench.py [benchmark ...]
+
+import argparse
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import time
+import weakref
+import libnacl.utils
+import paramiko
+import cbor
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread, Timer
+from messidge.loop import Loop
+from messidge.client.message import Message
+from paramiko.sftp import CMD_STAT
+from tfnz.location import Location
+from tfnz.tunnel import Tunnel, UdpTunnel, Proxy
+from tfnz.ssh import SshServer
+
+
+class FakeConnection:
+    """Stands in for the connection onto a location, with a real message loop on a background thread.
+    Tunnels are echoed straight back as if the container was running an echo server.
+    Messages are encrypted and serialised in both directions so the per-message cost is realistic.
+    If window is passed, tunnels are flow controlled as the location would."""
+
+    def __init__(self, window=None):
+        self.rid = b''
+        self.session_key = libnacl.utils.salsa_key()
+        self.window = window
+        self.tunnels = {}
+        self.outstanding = {}  # (tunnel, proxy) -> bytes sent but not acknowledged
+        self.held = {}  # (tunnel, proxy) -> data waiting for the window to open
+        self.reverses = {}  # tunnel -> {proxy: socket} for connections accepted 'inside the container'
+        self.location = FakeLocation(self)
+        self.send_skts_destroyed = 0
+        self.loop = Loop()
+        self.posted = deque()  # calls to be made on the loop thread, as messages from the location would be
+        self.post_r, self.post_w = socket.socketpair()
+        self.post_r.setblocking(False)
+        self.thread = Thread(target=self.loop.run, name="Benchmark message loop")
+        self.thread.start()
+
+    def stop(self):
+        self.loop.stop()
+        self.thread.join()
+
+    def deliver(self, msg):
+        # as the message loop would - checked against, then dispatched through, Location's command table
+        handler = Location._commands[msg.command]
+        Loop.check_basic_properties(msg, handler)
+        getattr(Location, '_' + msg.command.decode())(self.location, msg)
+
+    def post(self, call, *args):
+        # registered on first use, an idle loop only notices new registrations when its poll times out
+        if self.post_r.fileno() not in self.loop.exclusive_handlers:
+            self.loop.register_exclusive(self.post_r.fileno(), self.posted_event, comment="Benchmark posted calls")
+        self.posted.append((call, args))
+        self.post_w.send(b'x')
+
+    def call(self, call, *args):
+        # make a call on the loop thread and wait for it to complete - i.e. destroying a tunnel the loop is using
+        done = Event()
+
+        def run():
+            try:
+                call(*args)
+            finally:
+                done.set()
+        self.post(run)
+        done.wait()
+
+    def posted_event(self, fd):
+        try:
+            self.post_r.recv(65536)
+        except BlockingIOError:
+            pass
+        while len(self.posted) != 0:
+            call, args = self.posted.popleft()
+            call(*args)
+
+    def destroy_send_skt_for(self, thread):
+        self.send_skts_destroyed += 1  # there are no per-thread sockets here, just count
+
+    def register_connect_callback(self, callback):
+        pass
+
+    def unregister_connect_callback(self, callback):
+        pass
+
+    def wire(self, command, uuid, params, bulk) -> Message:
+        # there and back again
+        nonce = libnacl.utils.rand_nonce()
+        params, bulk = Message.encrypted_params(params, bulk, nonce, self.session_key)
+        parts = cbor.loads(cbor.dumps([nonce, command, uuid, params, bulk]))
+        msg = Message()
+        msg.command = parts[1]
+        msg.uuid = parts[2]
+        msg.params, msg.bulk = Message.decrypted_params(parts[3], parts[4], parts[0], self.session_key)
+        return msg
+
+    def send_blocking_cmd(self, cmd, params=None, bulk=b''):
+        msg = self.wire(cmd, b'', params, bytes(bulk))
+        if cmd != b'create_reverse_tunnel':
+            raise ValueError("Not handled by the benchmark: " + cmd.decode())
+        # listen on the local port as if inside the container
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('127.0.0.1', msg.params['port']))
+        listener.listen()
+        self.reverses[msg.params['tunnel']] = {}
+        Thread(target=self.reverse_accept, args=(msg.params['tunnel'], listener), daemon=True).start()
+        return msg
+
+    def reverse_accept(self, uuid, listener):
+        proxy_id = 1
+        while True:
+            skt, addr = listener.accept()
+            self.reverses[uuid][proxy_id] = skt
+            self.post(self.deliver, self.wire(b'from_proxy', uuid, {'proxy': proxy_id}, b''))
+            Thread(target=self.reverse_read, args=(uuid, proxy_id, skt), daemon=True).start()
+            proxy_id += 1
+
+    def reverse_read(self, uuid, proxy_id, skt):
+        while True:
+            try:
+                data = skt.recv(Proxy.max_read)
+            except OSError:
+                return
+            tunnel = self.tunnels.get(uuid)
+            if tunnel is None:
+                return  # the tunnel has gone
+            if len(data) == 0:
+                self.post(self.deliver, self.wire(b'close_proxy', uuid, {'proxy': proxy_id}, b''))
+                return
+            self.post(self.deliver, self.wire(b'from_proxy', uuid, {'proxy': proxy_id}, data))
+
+    def send_cmd(self, cmd, params=None, bulk=b'', uuid=b'', reply_callback=None):
+        msg = self.wire(cmd, uuid, params, bytes(bulk))
+        if cmd in (b'to_proxy', b'close_proxy') and msg.params['tunnel'] in self.reverses:
+            skt = self.reverses[msg.params['tunnel']].get(msg.params['proxy'])
+            if skt is not None:
+                if cmd == b'to_proxy':
+                    skt.sendall(msg.bulk)
+                else:
+                    skt.shutdown(socket.SHUT_RDWR)
+            return
+        if cmd == b'run_process':
+            # 'runs' by echoing the command line back, replying from elsewhere as the location would
+            reply = self.wire(cmd, uuid, {'stdout': msg.params['command'].encode() + b'\n',
+                                          'stderr': b'', 'exit_code': 0}, b'')
+            Thread(target=reply_callback, args=(reply,)).start()
+        if cmd == b'create_tunnel' and self.window is not None:
+            self.deliver(self.wire(b'tunnel_window', uuid, {'window': self.window}, b''))
+        if cmd == b'to_proxy' and len(msg.bulk) != 0:
+            key = (msg.params['tunnel'], msg.params['proxy'])
+            if self.window is None:
+                self.from_proxy(key, msg.bulk)
+                return
+            # the container has taken the data so acknowledge, then echo when the window allows
+            self.deliver(self.wire(b'ack_proxy', key[0], {'proxy': key[1], 'bytes': len(msg.bulk)}, b''))
+            self.held[key] = self.held.get(key, b'') + msg.bulk
+            self.release(key)
+        if cmd == b'ack_proxy':
+            key = (msg.params['tunnel'], msg.params['proxy'])
+            self.outstanding[key] -= msg.params['bytes']
+            self.release(key)
+
+    def release(self, key):
+        space = self.window - self.outstanding.get(key, 0)
+        data = self.held.get(key, b'')
+        if space <= 0 or len(data) == 0:
+            return
+        self.held[key] = data[space:]
+        self.outstanding[key] = self.outstanding.get(key, 0) + min(space, len(data))
+        self.from_proxy(key, data[:space])
+
+    def from_proxy(self, key, data):
+        self.deliver(self.wire(b'from_proxy', key[0], {'proxy': key[1]}, data))
+
+
+class FakeFilesystemConnection(FakeConnection):
+    """A connection onto a location whose container's filesystem is a local directory,
+    and whose processes are run locally in that directory.
+    Blocking commands and write acknowledgements are delayed by 'latency' seconds, as a round trip would be."""
+
+    def __init__(self, root, latency=0.0):
+        super().__init__()
+        self.root = root
+        self.latency = latency
+
+    def path(self, filename):
+        return os.path.join(self.root, filename.lstrip('/'))
+
+    def send_blocking_cmd(self, cmd, params=None, bulk=b''):
+        if cmd not in self.blocking_commands:
+            return super().send_blocking_cmd(cmd, params, bulk)
+        time.sleep(self.latency)
+        msg = self.wire(cmd, b'', params, bytes(bulk))
+        try:
+            params, bulk = self.blocking_commands[cmd](self, msg.params, msg.bulk)
+        except OSError as e:
+            if cmd in (b'fetch_file', b'put_file', b'run_process'):
+                raise ValueError(str(e))  # these are reported as exceptions rather than errno's
+            params, bulk = {'error': e.errno}, b''
+        return self.wire(cmd, b'', params, bulk)
+
+    def fetch_file(self, params, bulk):
+        with open(self.path(params['filename']), 'rb') as f:
+            f.seek(params.get('offset', 0))
+            return {}, f.read(params.get('length', -1))
+
+    def put_file(self, params, bulk):
+        os.makedirs(os.path.dirname(self.path(params['filename'])), exist_ok=True)
+        with open(self.path(params['filename']), 'wb') as f:
+            f.write(bulk)
+        return {}, b''
+
+    def stat_file(self, params, bulk):
+        return {'stat': tuple(os.stat(self.path(params['filename'])))}, b''
+
+    def lstat_file(self, params, bulk):
+        return {'lstat': tuple(os.lstat(self.path(params['filename'])))}, b''
+
+    def ls_dir(self, params, bulk):
+        directory = self.path(params['directory'])
+        return {'entries': [(name, tuple(os.lstat(os.path.join(directory, name))))
+                            for name in os.listdir(directory)]}, b''
+
+    def rm_file(self, params, bulk):
+        os.unlink(self.path(params['filename']))
+        return {}, b''
+
+    def mv_file(self, params, bulk):
+        os.rename(self.path(params['filename']), self.path(params['newpath']))
+        return {}, b''
+
+    def mk_dir(self, params, bulk):
+        os.mkdir(self.path(params['directory']))
+        return {}, b''
+
+    def rm_dir(self, params, bulk):
+        os.rmdir(self.path(params['directory']))
+        return {}, b''
+
+    def run_process(self, params, bulk):
+        done = subprocess.run(params['command'], shell=True, cwd=self.root,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return {'stdout': done.stdout, 'stderr': done.stderr, 'exit_code': str(done.returncode)}, b''
+
+    blocking_commands = {b'fetch_file': fetch_file,
+                         b'put_file': put_file,
+                         b'stat_file': stat_file,
+                         b'lstat_file': lstat_file,
+                         b'ls_dir': ls_dir,
+                         b'rm_file': rm_file,
+                         b'mv_file': mv_file,
+                         b'mk_dir': mk_dir,
+                         b'rm_dir': rm_dir,
+                         b'run_process': run_process}
+
+    def send_cmd(self, cmd, params=None, bulk=b'', uuid=b'', reply_callback=None):
+        if cmd == b'write_file':
+            msg = self.wire(cmd, uuid, params, bytes(bulk))
+            filename = self.path(msg.params['filename'])
+            try:
+                with open(filename, 'r+b' if os.path.exists(filename) else 'wb') as f:
+                    f.seek(msg.params['offset'])
+                    f.write(msg.bulk)
+                reply = {}
+            except OSError as e:
+                reply = {'exception': str(e)}
+            self.reply(reply_callback, self.wire(cmd, uuid, reply, b''))
+            return
+        if cmd == b'run_process':
+            def run():
+                reply = self.send_blocking_cmd(cmd, params)
+                self.post(reply_callback, self.wire(cmd, uuid, reply.params, b''))
+            Thread(target=run).start()
+            return
+        super().send_cmd(cmd, params, bulk, uuid, reply_callback)
+
+    def reply(self, callback, msg):
+        # replies arrive on the loop thread, a round trip later
+        if self.latency == 0:
+            self.post(callback, msg)
+        else:
+            Timer(self.latency, self.post, (callback, msg)).start()
+
+
+class FakeLocation:
+    def __init__(self, conn):
+        self.conn = conn
+        self.capabilities = {'reverse_tunnel'}
+
+    @property
+    def tunnels(self):
+        return self.conn.tunnels
+
+    def add_tunnel(self, tunnel):
+        self.conn.tunnels[tunnel.uuid] = tunnel
+
+    def remove_tunnel(self, tunnel):
+        self.conn.tunnels.pop(tunnel.uuid, None)
+
+    def destroy_tunnel(self, tunnel, container=None, with_command=True):
+        tunnel.destroy(with_command)
+        self.remove_tunnel(tunnel)
+
+
+class FakeNode:
+    def __init__(self, location):
+        self.pk = b'benchmark'
+        self.location = location
+
+    def parent(self):
+        return self.location
+
+
+class FakeContainer:
+    def __init__(self, conn=None):
+        self.uuid = b'benchmark'
+        if conn is not None:
+            self.conn = weakref.ref(conn)
+            self.node = FakeNode(FakeLocation(conn))
+
+    def parent(self):
+        return self.node
+
+    def spawn_process(self, remote_command, data_callback=None, stderr_callback=None, termination_callback=None):
+        # 'runs' by echoing the command line back then exiting
+        process = FakeProcess()
+
+        def run():
+            data_callback(process, remote_command.encode() + b'\n')
+            termination_callback(process, 0)
+
+        Thread(target=run).start()
+        return process
+
+
+class FakeFilesystemContainer(FakeContainer):
+    """A container on a FakeFilesystemConnection, processes are run locally."""
+
+    def fetch(self, filename, *, offset=None, length=None):
+        params = {'node': self.node.pk, 'container': self.uuid, 'filename': filename}
+        if offset is not None:
+            params['offset'] = offset
+        if length is not None:
+            params['length'] = length
+        return self.conn().send_blocking_cmd(b'fetch_file', params).bulk
+
+    def spawn_process(self, remote_command, data_callback=None, stderr_callback=None, termination_callback=None):
+        process = FakeProcess()
+
+        def run():
+            msg = self.conn().send_blocking_cmd(b'run_process', {'node': self.node.pk,
+                                                                 'container': self.uuid,
+                                                                 'command': remote_command})
+            if len(msg.params['stdout']) != 0:
+                data_callback(process, msg.params['stdout'])
+            if len(msg.params['stderr']) != 0 and stderr_callback is not None:
+                stderr_callback(process, msg.params['stderr'])
+            termination_callback(process, int(msg.params['exit_code']))
+
+        Thread(target=run).start()
+        return process
+
+
+class FakeProcess:
+    def __init__(self):
+        self.uuid = b'process'
+        self.dead = False
+
+    def stdin(self, data):
+        pass
+
+    def destroy(self):
+        self.dead = True
+
+
+def tunnel(conn, container, path=None):
+    tnl = Tunnel(conn, None, container, 7, bind=None if path is not None else '127.0.0.1', path=path)
+    conn.tunnels[tnl.uuid] = tnl
+    tnl.connect()
+    return tnl
+
+
+def free_port():
+    skt = socket.socket()
+    skt.bind(('127.0.0.1', 0))
+    port = skt.getsockname()[1]
+    skt.close()
+    return port
+
+
+def echo(client, megabytes):
+    # write and read back through an echo server at the same time, returns the time taken
+    block = b'x' * 65536
+    total = megabytes * 1024 * 1024
+
+    def writer():
+        sent = 0
+        while sent < total:
+            client.sendall(block)
+            sent += len(block)
+
+    start = time.time()
+    write_thread = Thread(target=writer)
+    write_thread.start()
+    received = 0
+    while received < total:
+        received += len(client.recv(1024 * 1024))
+    elapsed = time.time() - start
+    write_thread.join()
+    return elapsed
+
+
+def bench_tunnel_throughput(megabytes=256, window=None, path=None):
+    """MB/s through a tunnel onto an echo server"""
+    conn = FakeConnection(window)
+    container = FakeContainer()
+    tnl = tunnel(conn, container, path)
+    assert tnl.window == window  # the advert made it through Location's command table
+
+    if path is None:
+        client = socket.create_connection(('127.0.0.1', tnl.localport()))
+    else:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+    elapsed = echo(client, megabytes)
+    client.close()
+    conn.call(tnl.destroy, False)
+    conn.stop()
+    print("tunnel throughput%s%s: %.1f MB/s (%d MB echoed in %.2fs)" %
+          ('' if window is None else ' (windowed)', '' if path is None else ' (unix socket)',
+           megabytes / elapsed, megabytes, elapsed))
+
+
+def bench_tunnel_windowed(megabytes=256):
+    """MB/s through a flow controlled tunnel onto an echo server"""
+    bench_tunnel_throughput(megabytes, window=Proxy.window)
+
+
+def bench_tunnel_unix(megabytes=256):
+    """MB/s through a tunnel listening on a unix domain socket onto an echo server"""
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_tunnel_throughput(megabytes, path=os.path.join(tmp, 'tunnel.sock'))
+
+
+def bench_tunnel_connection_storm(connections=500, concurrency=100):
+    """Latency of connecting and round tripping a byte while many clients connect to a tunnel at once"""
+    conn = FakeConnection()
+    container = FakeContainer()
+    tnl = tunnel(conn, container)
+    address = ('127.0.0.1', tnl.localport())
+
+    def connect(_):
+        start = time.time()
+        client = socket.create_connection(address)
+        client.sendall(b'x')
+        client.recv(1)
+        latency = time.time() - start
+        client.close()
+        return latency
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(connect, range(connections)))
+    elapsed = time.time() - start
+
+    conn.call(tnl.destroy, False)
+    conn.stop()
+    print("tunnel connection storm: %d connections in %.2fs, latency mean=%.1fms p99=%.1fms max=%.1fms" %
+          (connections, elapsed, 1000 * sum(latencies) / len(latencies),
+           1000 * latencies[int(len(latencies) * 0.99)], 1000 * latencies[-1]))
+
+
+def bench_udp_round_trip(datagrams=20000, peers=10):
+    """Round trip latency of small datagrams through a udp tunnel onto an echo server"""
+    conn = FakeConnection()
+    container = FakeContainer()
+    tnl = UdpTunnel(conn, None, container, 8125, bind='127.0.0.1')
+    conn.tunnels[tnl.uuid] = tnl
+    tnl.connect()
+    address = ('127.0.0.1', tnl.localport())
+
+    def peer(count):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(1)
+        latencies = []
+        for n in range(count):
+            start = time.time()
+            client.sendto(b'metric.name:%d|c' % n, address)
+            client.recv(65536)
+            latencies.append(time.time() - start)
+        client.close()
+        return latencies
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=peers) as executor:
+        latencies = sorted(sum(executor.map(peer, [datagrams // peers] * peers), []))
+    elapsed = time.time() - start
+
+    conn.call(tnl.destroy, False)
+    conn.stop()
+    print("udp round trip: %d datagrams from %d peers in %.2fs, latency mean=%.3fms p99=%.3fms" %
+          (len(latencies), peers, elapsed, 1000 * sum(latencies) / len(latencies),
+           1000 * latencies[int(len(latencies) * 0.99)]))
+
+
+def bench_ssh_forward(megabytes=128):
+    """MB/s through 'ssh -L' onto an echo server"""
+    os.makedirs(os.path.expanduser('~/.20ft'), exist_ok=True)  # for the host key
+    conn = FakeConnection()
+    container = FakeContainer(conn)
+    server = SshServer(container, free_port())
+    server.start()
+    localport = free_port()
+    ssh = subprocess.Popen(['ssh', '-N', '-p', str(server.port), '-L', '%d:localhost:7' % localport,
+                            '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                            '-o', 'LogLevel=ERROR', 'root@127.0.0.1'])
+    try:
+        client = None
+        for attempt in range(50):
+            try:
+                client = socket.create_connection(('127.0.0.1', localport))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        if client is None:
+            print("ssh forward: could not connect through ssh")
+            return
+        elapsed = echo(client, megabytes)
+        client.close()
+        print("ssh forward throughput: %.1f MB/s (%d MB echoed in %.2fs)" % (megabytes / elapsed, megabytes, elapsed))
+    finally:
+        server.stop()
+        ssh.terminate()
+        ssh.wait()
+        conn.stop()
+
+
+def echo_server():
+    # a local echo server, returns the port it's listening on
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+
+    def serve(skt):
+        while True:
+            data = skt.recv(65536)
+            if len(data) == 0:
+                skt.close()
+                return
+            skt.sendall(data)
+
+    def accept():
+        while True:
+            Thread(target=serve, args=(listener.accept()[0],), daemon=True).start()
+
+    Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def bench_ssh_reverse(connections=200):
+    """Connections per second through 'ssh -R' onto an echo server, each connection is opened, echoes and closes"""
+    os.makedirs(os.path.expanduser('~/.20ft'), exist_ok=True)  # for the host key
+    conn = FakeConnection()
+    container = FakeContainer(conn)
+    server = SshServer(container, free_port())
+    server.start()
+    remote_port = free_port()
+    ssh = subprocess.Popen(['ssh', '-N', '-p', str(server.port), '-R', '%d:127.0.0.1:%d' % (remote_port, echo_server()),
+                            '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+                            '-o', 'LogLevel=ERROR', 'root@127.0.0.1'])
+    try:
+        for attempt in range(50):
+            if len(conn.reverses) != 0:
+                break
+            time.sleep(0.1)
+        else:
+            print("ssh reverse: the reverse tunnel was not created")
+            return
+
+        def round_trip():
+            client = socket.create_connection(('127.0.0.1', remote_port))
+            client.sendall(b'x' * 64)
+            received = 0
+            while received < 64:
+                received += len(client.recv(64))
+            client.close()
+
+        round_trip()  # warm up
+        latencies = []
+        start = time.time()
+        for connection in range(connections):
+            began = time.time()
+            round_trip()
+            latencies.append(time.time() - began)
+        elapsed = time.time() - start
+        latencies.sort()
+        print("ssh reverse: %d connections/s, latency mean=%.1fms p99=%.1fms" %
+              (connections / elapsed, 1000 * sum(latencies) / len(latencies),
+               1000 * latencies[int(len(latencies) * 0.99)]))
+    finally:
+        server.stop()
+        ssh.terminate()
+        ssh.wait()
+        conn.stop()
+
+
+def bench_ssh_sessions(sessions=20, fast_exec=False, mux=False):
+    """Time taken to connect and run a command with the ssh client, one session after another"""
+    os.makedirs(os.path.expanduser('~/.20ft'), exist_ok=True)  # for the host key
+    conn = FakeConnection()
+    container = FakeContainer(conn)
+    start = time.time()
+    server = SshServer(container, free_port(), fast_exec)
+    server.start()
+    startup = time.time() - start
+    command = ['ssh', '-p', str(server.port), '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
+               '-o', 'LogLevel=ERROR']
+    with tempfile.TemporaryDirectory() as tmp:
+        if mux:
+            command += ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + os.path.join(tmp, 'control'),
+                        '-o', 'ControlPersist=10']
+        command += ['root@127.0.0.1', 'true']
+        try:
+            latencies = []
+            for session in range(sessions):
+                start = time.time()
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+                latencies.append(time.time() - start)
+            latencies.sort()
+            print("ssh sessions%s%s: server started in %.1fms, %d sessions latency mean=%.1fms max=%.1fms" %
+                  (" (fast exec)" if fast_exec else "", " (multiplexed)" if mux else "",
+                   1000 * startup, sessions, 1000 * sum(latencies) / len(latencies), 1000 * latencies[-1]))
+        finally:
+            if mux:
+                subprocess.run(command[:-2] + ['-O', 'exit', 'root@127.0.0.1'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)
+            server.stop()
+            conn.stop()
+
+
+def bench_ssh_sessions_fast():
+    bench_ssh_sessions(fast_exec=True)
+
+
+def bench_ssh_sessions_mux():
+    bench_ssh_sessions(fast_exec=True, mux=True)
+
+
+def sftp_location(root, latency, fast_exec=False):
+    # an ssh server onto a container whose filesystem is 'root'
+    os.makedirs(os.path.expanduser('~/.20ft'), exist_ok=True)  # for the host key
+    conn = FakeFilesystemConnection(root, latency)
+    container = FakeFilesystemContainer(conn)
+    server = SshServer(container, free_port(), fast_exec)
+    server.start()
+    return conn, container, server
+
+
+def sftp_batch(port, commands):
+    # run the sftp client on a batch of commands, returns the time taken
+    start = time.time()
+    done = subprocess.run(['sftp', '-P', str(port), '-b', '-', '-o', 'StrictHostKeyChecking=no',
+                           '-o', 'UserKnownHostsFile=/dev/null', '-o', 'LogLevel=ERROR', 'root@127.0.0.1'],
+                          input=commands, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300)
+    if done.returncode != 0:
+        raise RuntimeError("sftp failed: " + done.stderr.decode())
+    return time.time() - start
+
+
+def bench_sftp_get(megabytes=64, latency=0.001):
+    """MB/s fetching a file with the sftp client"""
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as local:
+        data = os.urandom(megabytes * 1024 * 1024)
+        with open(os.path.join(root, 'bench.bin'), 'wb') as f:
+            f.write(data)
+        conn, container, server = sftp_location(root, latency)
+        try:
+            setup = sftp_batch(server.port, b'pwd\n')
+            elapsed = sftp_batch(server.port, b'get /bench.bin ' + local.encode() + b'/bench.bin\n') - setup
+            with open(os.path.join(local, 'bench.bin'), 'rb') as f:
+                if f.read() != data:
+                    print("sftp get: the file came back different")
+                    return
+            print("sftp get: %.1f MB/s (%d MB in %.2fs, %.1fms latency)" %
+                  (megabytes / elapsed, megabytes, elapsed, 1000 * latency))
+        finally:
+            server.stop()
+            conn.stop()
+
+
+def bench_sftp_put(megabytes=64, latency=0.001):
+    """MB/s writing a file with the sftp client"""
+    with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as local:
+        data = os.urandom(megabytes * 1024 * 1024)
+        with open(os.path.join(local, 'bench.bin'), 'wb') as f:
+            f.write(data)
+        conn, container, server = sftp_location(root, latency)
+        try:
+            setup = sftp_batch(server.port, b'pwd\n')
+            elapsed = sftp_batch(server.port, b'put ' + local.encode() + b'/bench.bin /bench.bin\n') - setup
+            with open(os.path.join(root, 'bench.bin'), 'rb') as f:
+                if f.read() != data:
+                    print("sftp put: the file arrived different")
+                    return
+            print("sftp put: %.1f MB/s (%d MB in %.2fs, %.1fms latency)" %
+                  (megabytes / elapsed, megabytes, elapsed, 1000 * latency))
+        finally:
+            server.stop()
+            conn.stop()
+
+
+def bench_sftp_stat(files=1000, latency=0.001):
+    """Stat operations per second through sftp, one after another and pipelined"""
+    with tempfile.TemporaryDirectory() as root:
+        for n in range(files):
+            open(os.path.join(root, 'f%d' % n), 'w').close()
+        conn, container, server = sftp_location(root, latency)
+        transport = paramiko.Transport(('127.0.0.1', server.port))
+        try:
+            transport.start_client()
+            transport.auth_none('root')
+            client = paramiko.SFTPClient.from_transport(transport)
+
+            # one at a time, as a simple client would
+            sequential = files // 10
+            start = time.time()
+            for n in range(sequential):
+                client.stat('/f%d' % n)
+            sequential_rate = sequential / (time.time() - start)
+
+            # all in flight at once, as a file manager would (skipping the ones already cached)
+            start = time.time()
+            for n in range(sequential, files):
+                client._async_request(type(None), CMD_STAT, '/f%d' % n)
+            for n in range(sequential, files):
+                client._read_response()
+            pipelined_rate = (files - sequential) / (time.time() - start)
+            print("sftp stat: %d/s one at a time, %d/s pipelined (%.1fms latency)" %
+                  (sequential_rate, pipelined_rate, 1000 * latency))
+        finally:
+            transport.close()
+            server.stop()
+            conn.stop()
+
+
+def bench_ssh_exec(commands=20, latency=0.001):
+    """Latency running a command in the container with the ssh client, spawned and with fast exec"""
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'bench.txt'), 'w') as f:
+            f.write('benchmark\n')
+        for fast_exec in (False, True):
+            conn, container, server = sftp_location(root, latency, fast_exec)
+            command = ['ssh', '-p', str(server.port), '-o', 'StrictHostKeyChecking=no',
+                       '-o', 'UserKnownHostsFile=/dev/null', '-o', 'LogLevel=ERROR', 'root@127.0.0.1', 'cat bench.txt']
+            try:
+                subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=30)  # warm up
+                latencies = []
+                for n in range(commands):
+                    start = time.time()
+                    done = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30)
+                    latencies.append(time.time() - start)
+                    if done.stdout != b'benchmark\n':
+                        print("ssh exec: unexpected output: " + str(done.stdout))
+                        return
+                latencies.sort()
+                print("ssh exec%s: %d commands latency mean=%.1fms max=%.1fms (%.1fms latency)" %
+                      (" (fast exec)" if fast_exec else "", commands, 1000 * sum(latencies) / len(latencies),
+                       1000 * latencies[-1], 1000 * latency))
+            finally:
+                server.stop()
+                conn.stop()
+
+
+benchmarks = {'tunnel_throughput': bench_tunnel_throughput,
+              'tunnel_windowed': bench_tunnel_windowed,
+              'tunnel_unix': bench_tunnel_unix,
+              'tunnel_connection_storm': bench_tunnel_connection_storm,
+              'udp_round_trip': bench_udp_round_trip,
+              'ssh_forward': bench_ssh_forward,
+              'ssh_reverse': bench_ssh_reverse,
+              'ssh_sessions': bench_ssh_sessions,
+              'ssh_sessions_fast': bench_ssh_sessions_fast,
+              'ssh_sessions_mux': bench_ssh_sessions_mux,
+              'ssh_exec': bench_ssh_exec,
+              'sftp_get': bench_sftp_get,
+              'sftp_put': bench_sftp_put,
+              'sftp_stat': bench_sftp_stat}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='tf_bench')
+    parser.add_argument('benchmark', help='benchmarks to run (default all): ' + ', '.join(benchmarks), nargs='*')
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error("unknown benchmark: " + name)
+    logging.basicConfig(level=logging.WARNING)
+    for name in args.benchmark if len(args.benchmark) != 0 else benchmarks:
+        benchmarks[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -130,6 +130,15 @@ class TfTest(TestCase):
         self.assertTrue(b'Hello World!' in container.fetch('/usr/share/nginx/html/index.html'))
         node.destroy_container(container)
 
+        # the same bundle twice (only uploaded once where the location can do this)
+        preboot = [('/usr/share/nginx/html/index.html', b'Hello Twice!'),
+                   ('/usr/share/nginx/html/other.html', 'Hello Other!')]
+        containers = [node.spawn_container('nginx', pre_boot_files=preboot) for _ in range(0, 2)]
+        for container in containers:
+            self.assertTrue(container.fetch('/usr/share/nginx/html/index.html') == b'Hello Twice!')
+            self.assertTrue(container.fetch('/usr/share/nginx/html/other.html') == b'Hello Other!')
+            node.destroy_container(container)
+
     def test_volumes(self):
 
         def test_termination_callback(obj, returncode):
@@ -325,6 +334,58 @@ class TfTest(TestCase):
 
         node.destroy_container(ctr)
 
+    def test_ssh_exec(self):
+        node = TfTest.location.node()
+        ctr = node.spawn_container('alpine', sleep=True).wait_until_ready()
+        port = random.randrange(1024, 8192)
+        while True:
+            try:
+                ctr.create_ssh_server(port, fast_exec=True)
+                break
+            except RuntimeError:
+                port += random.randrange(1024, 8192)
+
+        # several commands down one connection
+        control = '/tmp/tf-test-%d' % port
+        ssh = ['/usr/bin/ssh', '-p', str(port), '-o', 'StrictHostKeyChecking=no',
+               '-o', 'ControlMaster=auto', '-o', 'ControlPath=' + control, '-o', 'ControlPersist=10']
+        for n in range(0, 3):
+            out = subprocess.run(ssh + ['root@localhost', 'echo %d; echo err >&2; exit %d' % (n, n)],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            self.assertTrue(out.stdout == b'%d\n' % n)
+            self.assertTrue(b'err' in out.stderr)
+            self.assertTrue(out.returncode == n)
+        subprocess.call(ssh + ['-O', 'exit', 'root@localhost'], stderr=subprocess.DEVNULL)
+
+        node.destroy_container(ctr)
+
+    def test_ssh_reverse(self):
+        node = TfTest.location.node()
+        ctr = node.spawn_container('alpine', sleep=True).wait_until_ready()
+        port = random.randrange(1024, 8192)
+        while True:
+            try:
+                ctr.create_ssh_server(port)
+                break
+            except RuntimeError:
+                port += random.randrange(1024, 8192)
+
+        # an http server here, reached from inside the container
+        http = subprocess.Popen(['python3', '-m', 'http.server', '8123'], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+        ssh = subprocess.Popen(['/usr/bin/ssh', '-N', '-p', str(port), '-o', 'StrictHostKeyChecking=no',
+                                '-R', '8080:localhost:8123', 'root@localhost'])
+        time.sleep(2)
+        try:
+            for n in range(0, 5):
+                stdout, stderr, exit_code = ctr.run_process('wget -O - http://localhost:8080/tf_test.py')
+                self.assertTrue(b'test_ssh_reverse' in stdout)
+        finally:
+            ssh.terminate()
+            http.terminate()
+
+        node.destroy_container(ctr)
+
     def test_reboot(self):
         # create a container with some preboot files
         preboot = [('/usr/share/nginx/html/index.html', b'Hello World!')]
@@ -616,6 +677,27 @@ class TfTest(TestCase):
         container.put('/a/brand/new/path/test', b'New Path Test')
         self.assertTrue(container.fetch('/a/brand/new/path/test') == b'New Path Test', 'New path test failed')
 
+        # ranges (or the whole file from a location that can't do ranges)
+        part = container.fetch('/a/brand/new/path/test', offset=4, length=4)
+        self.assertTrue(part == b'Path' or part == b'New Path Test', 'Ranged fetch failed')
+
+        # whole trees, there and back again
+        container.put_tree('docs', '/a/tree', compress=True)
+        self.assertTrue(container.fetch('/a/tree/index.rst') == open('docs/index.rst', 'rb').read(), 'put_tree failed')
+        container.fetch_tree('/a/tree', 'docs.fetched')
+        self.assertTrue(open('docs.fetched/index.rst', 'rb').read() == open('docs/index.rst', 'rb').read(),
+                        'fetch_tree failed')
+        subprocess.call(['rm', '-rf', 'docs.fetched'])
+
+        # a tree with a link that leads outside of where it's being fetched to
+        container.run_process('mkdir -p /a/evil && ln -s /etc /a/evil/escape')
+        try:
+            container.fetch_tree('/a/evil', 'evil.fetched')
+            self.assertTrue(False, 'Fetching a tree with a link to outside did not throw an exception')
+        except ValueError:
+            self.assertFalse(os.path.lexists('evil.fetched/escape'))
+        subprocess.call(['rm', '-rf', 'evil.fetched'])
+
         # try to reference outside the container
         try:
             container.put('../what.ever', b'Some Data')
@@ -632,6 +714,23 @@ class TfTest(TestCase):
 
         node.destroy_container(container)
 
+    def test_enqueue(self):
+        node = TfTest.location.node()
+        container = node.spawn_container('nginx')
+        self.assertFalse(container.is_ready())
+
+        # stage work while booting
+        put = container.enqueue(container.put, '/usr/share/nginx/html/index.html', b'Hello Queue')
+        fetch = container.enqueue(container.fetch, '/usr/share/nginx/html/index.html')
+        self.assertTrue(put.result(timeout=60) is None)
+        self.assertTrue(fetch.result(timeout=60) == b'Hello Queue')
+
+        # exceptions arrive through the future
+        fail = container.enqueue(container.fetch, '/usr')
+        self.assertTrue(isinstance(fail.exception(timeout=60), ValueError))
+
+        node.destroy_container(container)
+
     def test_spawn_process(self):
         # This test fails if noodle is running in the debugger
         node = TfTest.location.node()
@@ -649,6 +748,76 @@ class TfTest(TestCase):
 
         node.destroy_container(container)
 
+    def test_spawn_process_lines(self):
+        self.batches = []
+        self.terminated_process = None
+
+        def test_data_callback(obj, data):
+            self.batches.append(data)
+
+        def test_termination_callback(obj, returncode):
+            self.terminated_process = obj
+
+        node = TfTest.location.node()
+        container = node.spawn_container('debian', sleep=True)
+
+        # many lines then a final line with no newline
+        process = container.spawn_process('seq 1 20000; printf partial', data_callback=test_data_callback,
+                                          termination_callback=test_termination_callback,
+                                          lines=True, batch_size=1024)
+        time.sleep(5)
+        self.assertTrue(self.terminated_process is process, 'Termination callback not called')
+        self.assertTrue(len(self.batches) > 1, 'Output was not delivered in batches')
+
+        # batches only split on line boundaries, and the partial line was flushed on termination
+        for batch in self.batches[:-1]:
+            self.assertTrue(batch.endswith(b'\n'))
+        self.assertTrue(self.batches[-1].endswith(b'partial'))
+        expected = b''.join(b'%d\n' % n for n in range(1, 20001)) + b'partial'
+        self.assertTrue(b''.join(self.batches) == expected)
+
+        node.destroy_container(container)
+
+    def test_buffer_stdin_sockets(self):
+        self.test_data = b''
+        def test_data_callback(obj, data):
+            self.test_data += data
+
+        node = TfTest.location.node()
+        container = node.spawn_container('debian', sleep=True)
+        processes = [container.spawn_process('cat', data_callback=test_data_callback) for _ in range(5)]
+        conn = TfTest.location.conn
+        sockets = len(conn.thread_skt)
+
+        # each buffer sends from its own thread, with its own socket onto the location
+        for process in processes:
+            process.buffer_stdin()
+            process.stdin(b'Hello\n')
+        time.sleep(2)
+        self.assertTrue(self.test_data.count(b'Hello\n') == 5)
+        self.assertTrue(len(conn.thread_skt) == sockets + 5)
+
+        # which are released when the processes are destroyed
+        for process in processes:
+            container.destroy_process(process)
+        self.assertTrue(len(conn.thread_skt) == sockets, 'Stdin buffers leaked their sockets')
+
+        node.destroy_container(container)
+
+    def test_stream_process(self):
+        node = TfTest.location.node()
+        container = node.spawn_container('debian', sleep=True)
+
+        # stream a large amount of output but only keep the tail
+        stream = container.stream_process('seq 1 100000', retain=16)
+        received = b''.join(stream)
+        self.assertTrue(stream.returncode == 0)
+        self.assertTrue(received.endswith(b'99999\n100000\n'))
+        self.assertTrue(len(stream.stdout_tail) == 16)
+        self.assertTrue(bytes(stream.stdout_tail) == received[-16:])
+
+        node.destroy_container(container)
+
     def test_callbacks_shell(self):
         self.terminated_process = None
 
@@ -753,6 +922,62 @@ class TfTest(TestCase):
         reply = requests.get('http://127.0.0.1:' + str(tnl.localport()))
         self.assertTrue('Welcome to nginx!' in reply.text, 'Did not get the expected reply from container')
 
+        # traffic was counted
+        stats = tnl.stats()
+        self.assertTrue(stats['connections'] >= 2)
+        self.assertTrue(stats['bytes_in'] > len(reply.content))
+        self.assertTrue(stats['connect_latency'] is not None)
+        self.assertTrue(TfTest.location.tunnel_stats()['tunnels'][tnl.uuid] == tnl.stats())
+
+        node.destroy_container(container)
+
+    def test_tunnels_unix(self):
+        node = TfTest.location.node()
+        container = node.spawn_container('nginx')
+        container.wait_http_200()
+        path = '/tmp/tf_test_%s.sock' % shortuuid.uuid()
+        tnl = container.attach_tunnel(80, path=path)
+        self.assertTrue(tnl.localport() is None and tnl.localpath() == path)
+
+        # http over the unix socket
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(path)
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        reply = b''
+        while True:
+            data = client.recv(8192)
+            if len(data) == 0:
+                break
+            reply += data
+        client.close()
+        self.assertTrue(b'Welcome to nginx!' in reply, 'Did not get the expected reply from container')
+
+        # socket file is removed
+        container.destroy_tunnel(tnl)
+        self.assertFalse(os.path.exists(path))
+        node.destroy_container(container)
+
+    def test_tunnels_udp(self):
+        node = TfTest.location.node()
+        container = node.spawn_container('alpine', sleep=True)
+        container.spawn_process('nc -u -l -p 5353 -e /bin/cat')
+
+        # refused rather than being built as a tcp proxy by a location that can't do udp
+        if 'udp_tunnel' not in TfTest.location.capabilities:
+            self.assertRaises(ValueError, container.attach_udp_tunnel, 5353)
+            node.destroy_container(container)
+            return
+        tnl = container.attach_udp_tunnel(5353, localport=5454)
+
+        # echoed back to the right peer
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(10)
+        client.sendto(b'datagram\n', ('127.0.0.1', tnl.localport()))
+        self.assertTrue(client.recv(1024) == b'datagram\n', "Datagram did not make the round trip")
+        self.assertTrue(tnl.stats()['active'] == 1)
+        client.close()
+
+        container.destroy_tunnel(tnl)
         node.destroy_container(container)
 
     def test_contain_loop(self):
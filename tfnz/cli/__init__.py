@@ -179,6 +179,7 @@ class Interactive:
         self.stdin_attr = None
         self.container = container
         container.stdout_callback = Interactive.stdout_callback
+        container.buffer_stdin()  # so pasting doesn't send a message per character
         self.exit_read, self.exit_write = os.pipe()
         self.thread = Thread(target=self.stdin_loop, name="Stdin loop")
         self.thread.start()
@@ -196,8 +197,10 @@ class Interactive:
             ready = select.select((sys.stdin, self.exit_read), (), ())
             if self.exit_read in ready[0]:
                 return
-            data = sys.stdin.read(1)
-            self.container.stdin(data.encode())
+            data = os.read(sys.stdin.fileno(), 65536)  # whatever is ready, won't block after the select
+            if len(data) == 0:
+                return
+            self.container.stdin(data)
 
     @staticmethod
     def stdout_callback(obj, out):
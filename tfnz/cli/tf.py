@@ -98,10 +98,9 @@ copy the directory ~/.20ft (and it's contents) to this machine.""", file=stderr)
             # are we copying into a directory? append the original filename
             if files[1][-1:] == '/':
                 files[1] += files[0]
-            # try to read the file in
+            # open the file, it's hashed and sent a slab at a time (closed once the container has spawned)
             try:
-                with open(files[0], 'rb') as f:
-                    preboot.append((files[1], f.read()))
+                preboot.append((files[1], open(files[0], 'rb')))
             except FileNotFoundError:
                 print("Could not find the source pre-boot file: " + files[0], file=sys.stderr)
                 return None
@@ -234,11 +233,13 @@ copy the directory ~/.20ft (and it's contents) to this machine.""", file=stderr)
     except BaseException as e:
         print("Failed while spawning container: " + str(e), file=sys.stderr)
         return location
+    finally:
+        for _, f in preboot:
+            f.close()
 
     # create the tunnels
     try:
-        for m in portmap:
-            container.attach_tunnel(m[1], localport=m[0])
+        container.attach_tunnels([(m[1], m[0]) for m in portmap])
     except OSError as e:
         print("Failed while creating a tunnel onto the container: " + str(e))
         return location
@@ -11,13 +11,18 @@
 # ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import io
 import logging
+import os
+import shlex
 import shortuuid
+import tarfile
 import weakref
+from concurrent.futures import ThreadPoolExecutor, Future
 from typing import Optional, List, Callable
 from . import Waitable, Killable, Connectable, Taggable
-from .tunnel import Tunnel
-from .process import Process
+from .tunnel import Tunnel, UdpTunnel
+from .process import Process, ProcessStream, StdinBuffer
 from .ssh import SshServer
 
 
@@ -37,11 +42,47 @@ class Container(Waitable, Killable, Connectable):
         self.volumes = volumes
         self.stdout_callback = stdout_callback
         self.termination_callback = termination_callback
+        self.stdin_buffer = None
+        self.queue = None  # created on demand
+        self.queued = set()  # futures for calls that have not yet completed
 
     def start(self):
         """Start a container that was spawned with sleep=True"""
         self.conn().send_cmd(b'wake_container', {'node': self.parent().pk, 'container': self.uuid})
 
+    def enqueue(self, method: Callable, *args, **kwargs) -> Future:
+        """Queue a call to be made once the container is running, without blocking the caller.
+
+        :param method: The method (or any callable) to call, i.e. container.put.
+        :param args: Positional arguments for the call.
+        :param kwargs: Keyword arguments for the call.
+        :return: A concurrent.futures.Future for the result.
+
+        Queued calls are made in order, one at a time, on a background thread.
+        Use this to stage work (put, run_process, allow_connection_from etc.) while the container boots.
+        Calls that haven't started when the container is destroyed are cancelled."""
+        self.ensure_alive()
+        if self.queue is None:
+            self.queue = ThreadPoolExecutor(max_workers=1)
+        future = self.queue.submit(self._when_ready, method, args, kwargs)
+        self.queued.add(future)
+        future.add_done_callback(self.queued.discard)
+        return future
+
+    def _when_ready(self, method, args, kwargs):
+        # runs on the queue's thread
+        self.ensure_alive()
+        self.wait_until_ready()
+        self.ensure_alive()  # may have been destroyed while we waited
+        return method(*args, **kwargs)
+
+    @staticmethod
+    def _release_send_skt(conn):
+        # runs on the queue's thread, last
+        conn = conn()
+        if conn is not None:
+            conn.destroy_send_skt()
+
     def private_ip(self):
         """Reports the container's ip address"""
         self.ensure_alive()
@@ -57,6 +98,24 @@ class Container(Waitable, Killable, Connectable):
 
         :param data: The data to be written."""
         self.ensure_alive()
+        if self.stdin_buffer is not None:
+            self.stdin_buffer.write(data)
+            return
+        self._send_stdin(data)
+
+    def buffer_stdin(self, *, window: Optional[float]=0.005, threshold: Optional[int]=65536):
+        """Coalesce writes to the container's stdin into fewer, larger messages.
+
+        :param window: The longest time (in seconds) a write will be held before being sent.
+        :param threshold: Send immediately once this many bytes are waiting."""
+        self.ensure_alive()
+        if self.stdin_buffer is None:
+            self.stdin_buffer = StdinBuffer(self._send_stdin, self.conn, window, threshold,
+                                            "Stdin buffer: " + self.uuid.decode())
+
+    def _send_stdin(self, data):
+        if self.dead:
+            return
         self.wait_until_ready()
         self.conn().send_cmd(b'stdin_container', {'node': self.parent().pk,
                                                   'container': self.uuid},
@@ -85,20 +144,62 @@ class Container(Waitable, Killable, Connectable):
         self.wait_until_ready()
         return self.location().wait_http_200(self, dest_port, fqdn, path)
 
-    def attach_tunnel(self, dest_port: int, *, localport: Optional[int]=None, bind: Optional[str]=None) -> Tunnel:
+    def attach_tunnel(self, dest_port: int, *, localport: Optional[int]=None, bind: Optional[str]=None,
+                      prewarm: Optional[int]=0, path: Optional[str]=None) -> Tunnel:
         """Creates a TCP proxy between localhost and a container.
 
         :param dest_port: The TCP port on the container to connect to.
         :param localport: Optional choice of local port no - if not provided uses the dest_port.
         :param bind: Optionally bind to an address other than localhost.
+        :param prewarm: Keep this many connections open onto the container, ready for new local connections.
+        :param path: Listen on a unix domain socket at this path instead of a TCP port.
         :return: A Tunnel object.
 
         This call does no checking to ensure the server side is ready -
         but a failed connection will not destroy the tunnel itself and will poll until connected.
+
+        Pre-warming cuts the latency of short lived connections (i.e. http without keepalive),
+        unused connections are replaced every 30 seconds.
+
+        A unix domain socket avoids the loopback TCP stack and needs no free port,
+        the socket file is removed when the tunnel is destroyed. A stale socket file is replaced,
+        but OSError is raised if something is still listening on it.
         """
         self.ensure_alive()
+        if path is not None and (localport is not None or bind is not None):
+            raise ValueError("A tunnel can listen on either a path or a local port, not both")
+        localport = dest_port if localport is None and path is None else localport
+        return self.location().tunnel_onto(self, dest_port, localport, bind, prewarm=prewarm, path=path)
+
+    def attach_tunnels(self, ports: List, *, bind: Optional[str]=None) -> List[Tunnel]:
+        """Creates several TCP proxies between localhost and a container in one go.
+
+        :param ports: A list of either dest_port or (dest_port, localport) pairs.
+        :param bind: Optionally bind to an address other than localhost.
+        :return: A list of Tunnel objects, in the same order as the ports.
+
+        Waits for the container to be ready once, then creates the tunnels without waiting on each other."""
+        self.ensure_alive()
+        pairs = [(port, port) if isinstance(port, (int, str)) else port for port in ports]
+        return self.location().tunnels_onto(self, pairs, bind)
+
+    def attach_udp_tunnel(self, dest_port: int, *, localport: Optional[int]=None, bind: Optional[str]=None) \
+            -> UdpTunnel:
+        """Creates a UDP proxy between localhost and a container.
+
+        :param dest_port: The UDP port on the container to send to.
+        :param localport: Optional choice of local port no - if not provided uses the dest_port.
+        :param bind: Optionally bind to an address other than localhost.
+        :return: A UdpTunnel object.
+
+        Replies are routed back to whichever local peer sent the datagram that opened the session,
+        sessions are forgotten after 60 seconds without traffic.
+        Raises ValueError if the location doesn't support udp tunnels."""
+        self.ensure_alive()
+        if 'udp_tunnel' not in self.location().capabilities:
+            raise ValueError("The location does not support udp tunnels")
         localport = dest_port if localport is None else localport
-        return self.location().tunnel_onto(self, dest_port, localport, bind)
+        return self.location().udp_tunnel_onto(self, dest_port, localport, bind)
 
     def destroy_tunnel(self, tunnel: Tunnel):
         """Destroy a tunnel
@@ -112,7 +213,7 @@ class Container(Waitable, Killable, Connectable):
 
         :return: A list of Tunnel objects"""
         self.ensure_alive()
-        return [t for t in self.location().tunnels.values() if t.container() == self]
+        return list(self.location().container_tunnels.get(self.uuid, {}).values())
 
     def allow_connection_from(self, container: 'Container'):
         """Allow another container to call this one over private ip
@@ -134,14 +235,22 @@ class Container(Waitable, Killable, Connectable):
     def spawn_process(self, remote_command: str,
                       data_callback: Optional[Callable]=None,
                       termination_callback: Optional[Callable]=None,
-                      stderr_callback: Optional[Callable]=None) -> Process:
+                      stderr_callback: Optional[Callable]=None, *,
+                      lines: Optional[bool]=False,
+                      batch_interval: Optional[float]=0.25,
+                      batch_size: Optional[int]=65536) -> Process:
         """Spawn a process within a container, receives data asynchronously via a callback.
 
         :param remote_command: The command to remotely launch as a string (i.e. not list).
         :param data_callback: A callback for arriving data - signature (object, bytes).
         :param termination_callback: For when the process completes - signature (object), returncode.
         :param stderr_callback: For data emitted by the process's stderr stream - signature (object, bytes).
+        :param lines: Coalesce data into complete lines and deliver to the callbacks in batches.
+        :param batch_interval: When framing lines, the (approximate) longest time to hold a batch in seconds.
+        :param batch_size: When framing lines, deliver the batch once it is this many bytes.
         :return: A Process object.
+
+        Framing lines is worthwhile for processes that log heavily, i.e. 'tail -f'.
         """
         if isinstance(remote_command, list):
             raise ValueError("Pass the command as a single string (that gets passed to a shell), not a list")
@@ -157,7 +266,10 @@ class Container(Waitable, Killable, Connectable):
         self.processes[spawn_command_uuid] = Process(self, spawn_command_uuid,
                                                      data_callback,
                                                      termination_callback,
-                                                     stderr_callback)
+                                                     stderr_callback,
+                                                     lines=lines,
+                                                     batch_interval=batch_interval,
+                                                     batch_size=batch_size)
         self.conn().send_cmd(b'spawn_process', {'node': self.parent().pk,
                                                 'container': self.uuid,
                                                 'command': remote_command},
@@ -200,6 +312,32 @@ class Container(Waitable, Killable, Connectable):
             stderr_callback(self, msg.params['stderr'])
         return msg.params['stdout'], msg.params['stderr'], msg.params['exit_code']
 
+    def stream_process(self, remote_command: str, *,
+                       retain: Optional[int]=65536,
+                       max_pending: Optional[int]=16 * 1024 * 1024,
+                       stderr_callback: Optional[Callable]=None,
+                       timeout: Optional[float]=None) -> ProcessStream:
+        """Run a process and iterate over its stdout as it arrives, rather than in a single reply.
+
+        :param remote_command: The command to run remotely.
+        :param retain: How many bytes from the end of stdout and stderr to keep for diagnostics, None for none.
+        :param max_pending: Discard the oldest unread output once this many bytes are waiting, None to keep it all.
+        :param stderr_callback: For data emitted by the process's stderr stream - signature (object, bytes).
+        :param timeout: Optionally raise TimeoutError if no output arrives within this many seconds.
+        :return: A ProcessStream object - iterate over it for bytes, then read returncode.
+
+        By default at most 16MB of unread output is held. When a process gets further ahead of the iterator than
+        max_pending, the oldest chunks are discarded (the most recent chunk is always kept) and the number of bytes
+        lost is counted in stream.dropped - iteration carries on from the oldest chunk still held.
+
+        Do not iterate over the stream from within a callback (i.e. on the message loop thread)."""
+        stream = ProcessStream(retain, max_pending, timeout, stderr_callback)
+        stream.process = self.spawn_process(remote_command,
+                                            data_callback=stream._stdout,
+                                            termination_callback=stream._terminated,
+                                            stderr_callback=stream._stderr)
+        return stream
+
     def spawn_shell(self, *,
                     data_callback: Optional[Callable]=None,
                     termination_callback: Optional[Callable]=None,
@@ -242,14 +380,15 @@ class Container(Waitable, Killable, Connectable):
         self.ensure_alive()
         return list(self.processes.values())
 
-    def create_ssh_server(self, port: int=2222) -> SshServer:
+    def create_ssh_server(self, port: int=2222, *, fast_exec: Optional[bool]=False) -> SshServer:
         """Create an ssh/sftp server on the given port.
 
         :param port: Local tcp port number
+        :param fast_exec: Run commands that don't ask for a pty in a single round trip - they get no stdin.
         :return: An SshServer object."""
         self.ensure_alive()
         self.wait_until_ready()
-        s = SshServer(self, port)
+        s = SshServer(self, port, fast_exec)
         s.start()
         self.ssh_servers[s.uuid] = s
         return s
@@ -264,18 +403,27 @@ class Container(Waitable, Killable, Connectable):
         server.stop()
         del self.ssh_servers[server.uuid]
 
-    def fetch(self, filename: str) -> bytes:
+    def fetch(self, filename: str, *, offset: Optional[int]=None, length: Optional[int]=None) -> bytes:
         """Fetch a single file from the container.
 
         :param filename: The full-path name of the file to be retrieved.
-        :return: the contents of the file as a bytes object.
+        :param offset: Optionally start reading at this offset.
+        :param length: Optionally read at most this many bytes.
+        :return: the contents of the file (or the requested range of it) as a bytes object.
 
-        Since the file gets loaded into memory, this is a bad way to move large files (>1GB)."""
+        Since the file gets loaded into memory, this is a bad way to move large files (>1GB) -
+        unless you fetch it a range at a time. A location that can't fetch ranges returns the whole file,
+        which can be spotted by receiving more than length bytes."""
         self.ensure_alive()
         self.wait_until_ready()
-        return self.conn().send_blocking_cmd(b'fetch_file', {'node': self.parent().pk,
-                                                             'container': self.uuid,
-                                                             'filename': filename}).bulk
+        params = {'node': self.parent().pk,
+                  'container': self.uuid,
+                  'filename': filename}
+        if offset is not None:
+            params['offset'] = offset
+        if length is not None:
+            params['length'] = length
+        return self.conn().send_blocking_cmd(b'fetch_file', params).bulk
 
     def put(self, filename: str, data: bytes):
         """Put a file into the container.
@@ -292,6 +440,75 @@ class Container(Waitable, Killable, Connectable):
                                                     'container': self.uuid,
                                                     'filename': filename}, bulk=data)
 
+    def put_tree(self, local_dir: str, remote_dir: str, *, compress: Optional[bool]=False):
+        """Copy a directory tree into the container.
+
+        :param local_dir: The directory to copy.
+        :param remote_dir: The full-path name of the directory to copy into, created on demand.
+        :param compress: Gzip the tree on the way.
+
+        The tree is sent as a single tar file and unpacked with tar in the container - much faster than
+        a file at a time for trees of many small files. As with put, the tree is held in memory."""
+        self.ensure_alive()
+        self.wait_until_ready()
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w:gz' if compress else 'w') as tar:
+            tar.add(local_dir, arcname='.')
+        tarname = '/tmp/.tf-tree-%s.tar' % shortuuid.uuid()
+        self.put(tarname, archive.getvalue())
+        stdout, stderr, exit_code = self.run_process('mkdir -p %s && tar -x%sf %s -C %s; rc=$?; rm -f %s; exit $rc' %
+                                                     (shlex.quote(remote_dir), 'z' if compress else '', tarname,
+                                                      shlex.quote(remote_dir), tarname))
+        if int(exit_code) != 0:
+            raise ValueError("Failed to unpack tree into %s: %s" % (remote_dir, stderr.decode()))
+
+    def fetch_tree(self, remote_dir: str, local_dir: str):
+        """Copy a directory tree out of the container.
+
+        :param remote_dir: The full-path name of the directory to copy.
+        :param local_dir: The directory to copy into, created on demand.
+
+        The tree is streamed out of the container by tar as it is read, so it is never held in memory."""
+        self.ensure_alive()
+        self.wait_until_ready()
+        # nothing can be dropped from an archive, we keep up with it as fast as the disk allows
+        stream = self.stream_process('tar -c -C %s .' % shlex.quote(remote_dir), retain=4096, max_pending=None)
+        try:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                tar.extraction_filter = getattr(tarfile, 'tar_filter', None)
+                for member in tar:
+                    Container._check_tree_member(member, local_dir)
+                    tar.extract(member, local_dir)
+        except tarfile.ReadError:
+            if stream.wait() == 0:
+                raise  # tar was happy, so it's the archive that's broken
+        except BaseException:
+            stream.destroy()
+            raise
+        if stream.wait() != 0:
+            raise ValueError("Failed to fetch tree from %s: %s" % (remote_dir, stream.stderr_tail.decode()))
+
+    @staticmethod
+    def _check_tree_member(member, local_dir):
+        # raises ValueError for anything that would be written, or link, outside of local_dir
+        # (on every Python - not all have tarfile's extraction filters)
+        root = os.path.realpath(local_dir)
+
+        def inside(path):
+            path = os.path.realpath(path)
+            return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+        path = os.path.join(root, member.name)
+        if os.path.isabs(member.name) or not inside(path):
+            raise ValueError("Refusing to unpack outside of %s: %s" % (local_dir, member.name))
+        if member.issym() and (os.path.isabs(member.linkname) or
+                               not inside(os.path.join(os.path.dirname(path), member.linkname))):
+            raise ValueError("Refusing to unpack a link to outside of %s: %s -> %s" %
+                             (local_dir, member.name, member.linkname))
+        if member.islnk() and (os.path.isabs(member.linkname) or not inside(os.path.join(root, member.linkname))):
+            raise ValueError("Refusing to unpack a link to outside of %s: %s -> %s" %
+                             (local_dir, member.name, member.linkname))
+
     def reboot(self, *, reset_filesystem: Optional[bool]=False):
         """Synchronously reboot a container, optionally resetting the filesystem.
 
@@ -329,6 +546,19 @@ class Container(Waitable, Killable, Connectable):
         for svr in list(self.ssh_servers.values()):
             self.destroy_ssh_server(svr)
 
+        # Send anything left for stdin
+        if self.stdin_buffer is not None:
+            self.stdin_buffer.close()
+
+        # Cancel queued calls that haven't started, and don't wait for one in progress.
+        # The queue's thread releases its socket onto the location once the call in progress has finished.
+        if self.queue is not None:
+            for future in list(self.queued):
+                future.cancel()
+            self.queue.submit(Container._release_send_skt, self.conn)
+            self.queue.shutdown(wait=False)
+            self.queue = None
+
         # Destroy (async)
         if send_cmd:
             logging.info("Destroying container: " + self.uuid.decode())
@@ -350,8 +580,10 @@ class Container(Waitable, Killable, Connectable):
             logging.debug("Message arrived for an unknown process: " + msg.uuid.decode())
             return
 
-        logging.debug("Received data from process: " + msg.uuid.decode())
-        logging.debug(msg.bulk.decode())
+        # avoid the cost of decoding every message unless we're actually going to log it
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Received data from process: " + msg.uuid.decode())
+            logging.debug(msg.bulk.decode(errors='replace'))
         self.processes[msg.uuid].give_me_messages(msg)
 
     def __repr__(self):
@@ -19,7 +19,7 @@ import requests
 import requests.exceptions
 import termios
 import sys
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Tuple, BinaryIO
 from base64 import b64encode
 from subprocess import run, CalledProcessError, DEVNULL
 from messidge import default_location
@@ -29,7 +29,7 @@ from .docker import Docker
 from .endpoint import WebEndpoint
 from .node import Node
 from .send import Sender
-from .tunnel import Tunnel
+from .tunnel import Tunnel, UdpTunnel, Proxy
 from .volume import Volume
 from .container import ExternalContainer
 
@@ -55,7 +55,10 @@ class Location(Waitable):
         self.volumes = TaggedCollection()
         self.externals = TaggedCollection()
         self.tunnels = {}
+        self.container_tunnels = {}  # container uuid -> {tunnel uuid: tunnel}
+        self.tunnel_buffer = bytearray(Proxy.max_read)  # shared by all the tunnels, only used on the loop thread
         self.endpoints = {}
+        self.capabilities = set()  # optional features the location has advertised in its resource offer
 
         # internal state you should probably ignore
         self.new_node_callback = new_node_callback
@@ -247,6 +250,25 @@ class Location(Waitable):
             Sender.send(docker_image_id, to_upload, self.conn)
         return layers
 
+    def ensure_files_uploaded(self, files: List[Tuple[str, Union[bytes, str, BinaryIO]]]) -> List[Tuple[str, str]]:
+        """Sends the contents of (pre-boot) files to the location, only if it doesn't already have them.
+
+        :param files: A list of (filename, data) pairs, data as bytes, str or a binary file opened for reading.
+        :return: A list of (filename, sha256) pairs.
+
+        Files are hashed and sent a slab at a time rather than being read into memory.
+        This is not a necessary step and is implied when spawning a container."""
+        by_hash = []
+        blobs = {}
+        for filename, data in files:
+            if isinstance(data, str):
+                data = data.encode()
+            sha256 = Sender.sha256(data)
+            by_hash.append((filename, sha256))
+            blobs[sha256] = data
+        Sender.send_blobs(blobs, self.conn)  # asks the location which it is missing
+        return by_hash
+
     @staticmethod
     def all_locations():
         """Returns a (text) list of 20ft locations that have an account on this machine."""
@@ -266,7 +288,7 @@ class Location(Waitable):
         self.last_heartbeat = time.time()
         self.conn.send_cmd(b'heartbeat')
 
-    def tunnel_onto(self, container, port, localport, bind, *, timeout=30) -> Tunnel:
+    def tunnel_onto(self, container, port, localport, bind, *, timeout=30, prewarm=0, path=None) -> Tunnel:
         # called from Container
         if isinstance(port, str):
             port = int(port)
@@ -275,11 +297,57 @@ class Location(Waitable):
 
         # create the tunnel
         container.wait_until_ready()  # otherwise the IP address may not exist on the node and creation will fail
-        tunnel = Tunnel(self.conn, container.parent(), container, port, localport, bind, timeout)
-        self.tunnels[tunnel.uuid] = tunnel
+        tunnel = Tunnel(self.conn, container.parent(), container, port, localport, bind, timeout, self.tunnel_buffer,
+                        prewarm, path)
+        self.add_tunnel(tunnel)
         tunnel.connect()  # connection done 'late' so we can get the tunnel into tunnels first
         return tunnel
 
+    def udp_tunnel_onto(self, container, port, localport, bind, *, timeout=30) -> UdpTunnel:
+        # called from Container
+        if isinstance(port, str):
+            port = int(port)
+        if isinstance(localport, str):
+            localport = int(localport)
+        container.wait_until_ready()
+        tunnel = UdpTunnel(self.conn, container.parent(), container, port, localport, bind, timeout, self.tunnel_buffer)
+        self.add_tunnel(tunnel)
+        tunnel.connect()
+        return tunnel
+
+    def tunnels_onto(self, container, ports, bind, *, timeout=30) -> List[Tunnel]:
+        # called from Container - ports is a list of (port, localport) pairs
+        container.wait_until_ready()
+        return [self.tunnel_onto(container, port, localport, bind, timeout=timeout) for port, localport in ports]
+
+    def add_tunnel(self, tunnel: Tunnel):
+        # index so messages can be routed to the tunnel, and tunnels can be found by container
+        self.tunnels[tunnel.uuid] = tunnel
+        ctr_uuid = tunnel.container().uuid
+        if ctr_uuid not in self.container_tunnels:
+            self.container_tunnels[ctr_uuid] = {}
+        self.container_tunnels[ctr_uuid][tunnel.uuid] = tunnel
+
+    def remove_tunnel(self, tunnel):
+        try:
+            del self.tunnels[tunnel.uuid]
+        except KeyError:
+            return
+        by_container = self.container_tunnels[tunnel.container().uuid]
+        del by_container[tunnel.uuid]
+        if len(by_container) == 0:
+            del self.container_tunnels[tunnel.container().uuid]
+
+    def tunnel_stats(self) -> dict:
+        """Returns traffic metrics for all the tunnels on this location.
+
+        :return: A dictionary of totals, with the stats for each tunnel (keyed by uuid) under 'tunnels'."""
+        tunnels = {uuid: tunnel.stats() for uuid, tunnel in list(self.tunnels.items())}
+        totals = {key: sum(stats[key] for stats in tunnels.values())
+                  for key in ('bytes_in', 'bytes_out', 'messages_in', 'messages_out', 'connections', 'active', 'errors')}
+        totals['tunnels'] = tunnels
+        return totals
+
     def wait_tcp(self, container, dest_port):
         # called from Container - raises a ValueError if it cannot connect before the timeout
         logging.info("Waiting on tcp (%d): %s" % (dest_port, container.uuid.decode()))
@@ -309,7 +377,7 @@ class Location(Waitable):
     def destroy_tunnel(self, tunnel: Tunnel, container=None, with_command=True):
         # Called from Container
         tunnel.destroy(with_command)
-        del self.tunnels[tunnel.uuid]
+        self.remove_tunnel(tunnel)
 
     def _from_proxy(self, msg):
         try:
@@ -322,6 +390,23 @@ class Location(Waitable):
         except KeyError:
             logging.debug("Data arrived from a proxy we seemingly already closed")
 
+    def _ack_proxy(self, msg):
+        try:
+            tunnel = self.tunnels[msg.uuid]
+        except KeyError:
+            logging.debug("Acknowledgement for an already removed tunnel (dropped)")
+            return
+        tunnel.ack_proxy(msg)
+
+    def _tunnel_window(self, msg):
+        # the location has agreed to flow control a tunnel
+        try:
+            tunnel = self.tunnels[msg.uuid]
+        except KeyError:
+            logging.debug("Window for an already removed tunnel (dropped)")
+            return
+        tunnel.enable_flow_control(msg.params['window'])
+
     def _close_proxy(self, msg):
         try:
             tunnel = self.tunnels[msg.uuid]
@@ -339,6 +424,7 @@ class Location(Waitable):
         self.volumes = TaggedCollection([Volume(self, vol['uuid'], vol['tag']) for vol in msg.params['volumes']])
         self.externals = TaggedCollection([ExternalContainer(self, xtn['uuid'], xtn['node'], xtn['ip'], xtn['tag'])
                                           for xtn in msg.params['externals']])
+        self.capabilities = set(msg.params.get('capabilities', []))  # older locations advertise none
 
         self.mark_as_ready()  # only ready once we've dealt with the resource offer
 
@@ -396,6 +482,8 @@ class Location(Waitable):
                  b'external_destroyed': (['container'], False),
                  b'from_proxy': (['proxy'], False),
                  b'close_proxy': (['proxy'], False),
+                 b'ack_proxy': (['proxy', 'bytes'], False),
+                 b'tunnel_window': (['window'], False),
                  b'update_stats': (['node', 'stats'], False),
                  b'log': (['error', 'log'], False)}
 
@@ -49,7 +49,8 @@ class Node:
         :param env: a list of environment name, value pairs to be passed.
         :param sleep: replaces the Entrypoint/Cmd with a single blocking command (container still boots).
         :param volumes: a list of (volume, mountpoint) pairs.
-        :param pre_boot_files: a list of (filename, data) pairs to write into the container before booting.
+        :param pre_boot_files: a list of (filename, data) pairs to write into the container before booting,
+            data can be bytes, str or a binary file opened for reading.
         :param command: ignores Entrypoint/Cmd and launches with this script instead, list not string.
         :param stdout_callback: Called when the container sends output - signature (container, string).
         :param termination_callback: For when the container completes - signature (container, returncode).
@@ -57,7 +58,8 @@ class Node:
         :return: A Container object.
 
         The resulting Container is initially a placeholder until the container has spawned.
-        Any layers that need to be uploaded to the location are uploaded automatically.
+        Any layers or pre-boot files that need to be uploaded to the location are uploaded automatically,
+        and (where the location supports it) pre-boot files with identical contents are only uploaded once.
         Note that the container will not be marked as ready until it actually has booted.
 
         To launch synchronously call wait_until_ready() on the container."""
@@ -96,6 +98,23 @@ class Node:
         vol_struct = [(vol[0].uuid, vol[1]) for vol in volumes] if volumes is not None else None
         layers = self.parent().ensure_image_uploaded(image, descr=descr)
 
+        # pre-boot files are uploaded (once) separately and only referenced by hash in the spawn message,
+        # locations that can't resolve the hashes are sent the files themselves
+        pre_boot_hashes = None
+        if pre_boot_files is not None and len(pre_boot_files) > 0 \
+                and 'pre_boot_hashes' in self.parent().capabilities:
+            pre_boot_hashes = self.parent().ensure_files_uploaded(pre_boot_files)
+            pre_boot_files = None
+        elif pre_boot_files is not None:
+            # sent inline, so files have to be read in
+            contents = []
+            for filename, data in pre_boot_files:
+                if not isinstance(data, (bytes, str)):
+                    data.seek(0)
+                    data = data.read()
+                contents.append((filename, data))
+            pre_boot_files = contents
+
         # Create the container object then tell the node to actually create it
         uuid = shortuuid.uuid().encode()
         self.containers[uuid] = Container(self, image, uuid, descr, env, volumes,
@@ -108,6 +127,7 @@ class Node:
                                                   'env': env,
                                                   'volumes': vol_struct,
                                                   'pre_boot_files': pre_boot_files,
+                                                  'pre_boot_hashes': pre_boot_hashes,
                                                   'sleep': sleep,
                                                   'cookie': cookie},
                              uuid=uuid,
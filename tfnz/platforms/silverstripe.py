@@ -80,8 +80,8 @@ class SilverStripe:
 
         # Start tailing logs
         for w in self.webservers:
-            w.spawn_process('tail -n 0 -f /var/log/nginx/access.log', data_callback=log_callback)
-            w.spawn_process('tail -n 0 -f /var/log/nginx/error.log', data_callback=log_callback)
+            w.spawn_process('tail -n 0 -f /var/log/nginx/access.log', data_callback=log_callback, lines=True)
+            w.spawn_process('tail -n 0 -f /var/log/nginx/error.log', data_callback=log_callback, lines=True)
 
     environment_template = """
 SS_BASE_URL="http://%s"
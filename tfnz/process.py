@@ -13,13 +13,18 @@
 
 import weakref
 import logging
+import time
+from collections import deque
+from threading import Condition, RLock, Thread, Timer, current_thread
+from typing import Optional
 from . import Killable
 
 
 class Process(Killable):
     """An object encapsulating a process within a container.
     Do not instantiate directly, use container.spawn_process."""
-    def __init__(self, parent, uuid, data_callback, termination_callback, stderr_callback=None):
+    def __init__(self, parent, uuid, data_callback, termination_callback, stderr_callback=None, *,
+                 lines=False, batch_interval=0.25, batch_size=65536):
         super().__init__()
         self.parent = weakref.ref(parent)
         self.node = weakref.ref(parent.parent())
@@ -29,6 +34,17 @@ class Process(Killable):
         self.termination_callback = termination_callback
         self.stderr_callback = stderr_callback
         self.wrapper = None
+        self.stdin_buffer = None
+
+        # optionally frame the output into lines, delivered in batches
+        self.framers = []
+        if lines:
+            if data_callback is not None:
+                self.data_callback = LineFramer(data_callback, batch_interval, batch_size)
+                self.framers.append(self.data_callback)
+            if stderr_callback is not None:
+                self.stderr_callback = LineFramer(stderr_callback, batch_interval, batch_size)
+                self.framers.append(self.stderr_callback)
 
     def stdin(self, data: bytes):
         """Inject data into stdin for the process.
@@ -48,6 +64,26 @@ class Process(Killable):
             self.destroy()
             return
 
+        if self.stdin_buffer is not None:
+            self.stdin_buffer.write(data)
+            return
+        self._send_stdin(data)
+
+    def buffer_stdin(self, *, window: Optional[float]=0.005, threshold: Optional[int]=65536):
+        """Coalesce writes to stdin into fewer, larger messages.
+
+        :param window: The longest time (in seconds) a write will be held before being sent.
+        :param threshold: Send immediately once this many bytes are waiting.
+
+        Worthwhile when stdin is written in many small pieces - i.e. pasting into a terminal."""
+        self.ensure_alive()
+        if self.stdin_buffer is None:
+            self.stdin_buffer = StdinBuffer(self._send_stdin, self.conn, window, threshold,
+                                            "Stdin buffer: " + self.uuid.decode())
+
+    def _send_stdin(self, data):
+        if self.dead:
+            return
         self.conn().send_cmd(b'stdin_process', {'node': self.node().pk,
                                                 'container': self.parent().uuid,
                                                 'process': self.uuid}, bulk=data)
@@ -57,12 +93,17 @@ class Process(Killable):
         if self.bail_if_dead():
             return
 
+        # anything still waiting to go into stdin goes first
+        if self.stdin_buffer is not None:
+            self.stdin_buffer.close()
+
         # and then wait for notice of termination in msg.bulk
         if with_command:
             self.conn().send_cmd(b'destroy_process', {'node': self.node().pk,
                                                       'container': self.parent().uuid,
                                                       'process': self.uuid})
         logging.info("Terminated client side: %s" % self.uuid.decode())
+        self._close_framers()
         self.mark_as_dead()
         if self.termination_callback is not None:
             self.termination_callback(self, 0)
@@ -78,7 +119,10 @@ class Process(Killable):
         # Has the process died?
         if len(msg.bulk) == 0:
             logging.info("Terminated server side: %s (%d)" % (self.uuid.decode(), msg.params['returncode']))
+            self._close_framers()
             self.mark_as_dead()
+            if self.stdin_buffer is not None:
+                self.stdin_buffer.close()
             if self.termination_callback is not None:
                 self.termination_callback(self, msg.params['returncode'])
             return
@@ -93,5 +137,250 @@ class Process(Killable):
         if self.data_callback is not None:
             self.data_callback(self, msg.bulk)
 
+    def _close_framers(self):
+        for framer in self.framers:
+            framer.close(self)
+        self.framers.clear()
+
     def __repr__(self):
         return "<Process '%s'>" % self.uuid.decode()
+
+
+class LineFramer:
+    """Coalesces data from a process into complete lines and delivers them in batches.
+    Behaves as a data callback, passing the batches on to the callback it wraps.
+
+    A batch is delivered from the message loop as data arrives, or from a timer if no more arrives within
+    'interval' - the lock keeps batches in order and stops a flush racing the loop."""
+    def __init__(self, callback, interval, size):
+        self.callback = callback
+        self.interval = interval
+        self.size = size
+        self.buffer = bytearray()
+        self.last_delivery = time.time()
+        self.lock = RLock()
+        self.timer = None
+        self.obj = None
+        self.closed = False
+
+    def __call__(self, obj, data):
+        with self.lock:
+            if self.closed:
+                return
+            self.obj = obj
+            self.buffer += data
+            if len(self.buffer) >= self.size or time.time() - self.last_delivery >= self.interval:
+                self.flush(obj)
+            if len(self.buffer) != 0 and self.timer is None:
+                self.timer = Timer(max(self.last_delivery + self.interval - time.time(), 0), self._expired)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _expired(self):
+        # the interval has passed with a batch still waiting
+        with self.lock:
+            self.timer = None
+            if not self.closed:
+                self.flush(self.obj)
+
+    def close(self, obj):
+        # delivers whatever is left, partial line or not
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.flush(obj, final=True)
+            self.closed = True
+
+    def flush(self, obj, final=False):
+        if len(self.buffer) == 0:
+            return
+        self.last_delivery = time.time()
+
+        # only deliver complete lines unless there's no more data to come, or no newline in a whole batch
+        end = len(self.buffer) if final else self.buffer.rfind(b'\n') + 1
+        if end == 0:
+            if len(self.buffer) < self.size:
+                return
+            end = len(self.buffer)
+        batch = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        self.callback(obj, batch)
+
+
+class StdinBuffer:
+    """Coalesces writes to stdin, sending them as fewer, larger messages.
+    Do not instantiate directly, use process.buffer_stdin or container.buffer_stdin.
+
+    Everything is sent from the buffer's own thread so messages cannot be reordered."""
+    def __init__(self, send, conn, window, threshold, name):
+        self.send = send
+        self.conn = conn
+        self.window = window
+        self.threshold = threshold
+        self.buffer = bytearray()
+        self.closed = False
+        self.cv = Condition()
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def write(self, data: bytes):
+        with self.cv:
+            # wait for the buffer thread to catch up - applies backpressure to the writer
+            while len(self.buffer) >= self.threshold and not self.closed:
+                self.cv.wait()
+            if self.closed:
+                return
+            self.buffer += data
+            self.cv.notify_all()
+
+    def close(self):
+        # sends anything still waiting before returning
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        if self.thread is not current_thread():
+            self.thread.join()
+
+    def _run(self):
+        try:
+            self._send_until_closed()
+        finally:
+            # sending gave this thread its own socket onto the location
+            conn = self.conn()
+            if conn is not None:
+                conn.destroy_send_skt()
+
+    def _send_until_closed(self):
+        # sends whatever was written once it has been waiting for 'window' seconds, or is over the threshold
+        while True:
+            with self.cv:
+                while len(self.buffer) == 0 and not self.closed:
+                    self.cv.wait()
+                deadline = time.time() + self.window
+                while len(self.buffer) < self.threshold and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cv.wait(remaining)
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                closed = self.closed
+                self.cv.notify_all()
+            if len(data) != 0:
+                self.send(data)
+            if closed:
+                return
+
+
+class ProcessStream:
+    """An iterator over the stdout of a process running within a container.
+    Do not instantiate directly, use container.stream_process.
+
+    Iterating yields stdout as bytes in the chunks it arrived in, and stops when the process terminates.
+    Unread output over max_pending bytes is discarded oldest first, and counted in 'dropped'.
+    The final bytes of both stdout and stderr are retained for diagnostics even after they have been consumed."""
+    def __init__(self, retain: Optional[int], max_pending: Optional[int], timeout: Optional[float],
+                 stderr_callback=None):
+        self.process = None
+        self.retain = 0 if retain is None else retain  # None retains nothing
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stderr_callback = stderr_callback
+        self.returncode = None
+        self.stdout_tail = bytearray()
+        self.stderr_tail = bytearray()
+        self.dropped = 0
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.cv = Condition()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        with self.cv:
+            while len(self.pending) == 0 and self.returncode is None:
+                if not self.cv.wait(timeout=self.timeout):
+                    raise TimeoutError("Timed out waiting for output from: " + str(self.process))
+            if len(self.pending) == 0:
+                raise StopIteration
+            data = self.pending.popleft()
+            self.pending_bytes -= len(data)
+            return data
+
+    def read(self, size: Optional[int]=-1) -> bytes:
+        """Read stdout as from a file, so the stream can be passed to anything expecting a file object.
+
+        :param size: The most bytes to return, or -1 to read until the process terminates.
+        :return: The bytes read - empty once the process has terminated and all the output has been read."""
+        if size is None or size < 0:
+            return b''.join(self)
+        chunks = []
+        length = 0
+        while length < size:
+            try:
+                data = next(self)
+            except StopIteration:
+                break
+            if length + len(data) > size:
+                # put the rest back for next time
+                keep = size - length
+                with self.cv:
+                    self.pending.appendleft(data[keep:])
+                    self.pending_bytes += len(data) - keep
+                data = data[:keep]
+            chunks.append(data)
+            length += len(data)
+        return b''.join(chunks)
+
+    def wait(self) -> int:
+        """Discard any remaining output and block until the process terminates.
+
+        :return: The process's exit code."""
+        for _ in self:
+            pass
+        return self.returncode
+
+    def destroy(self):
+        """Destroy the process (if it is still running)."""
+        if self.process is not None and not self.process.dead:
+            self.process.parent().destroy_process(self.process)
+
+    # callbacks from the Process (on the message loop thread)
+    def _stdout(self, obj, data):
+        with self.cv:
+            ProcessStream._retain(self.stdout_tail, data, self.retain)
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+
+            # discard the oldest output if the consumer has fallen too far behind
+            if self.max_pending is not None:
+                while self.pending_bytes > self.max_pending and len(self.pending) > 1:
+                    dropped = self.pending.popleft()
+                    self.pending_bytes -= len(dropped)
+                    self.dropped += len(dropped)
+            self.cv.notify()
+
+    def _stderr(self, obj, data):
+        with self.cv:
+            ProcessStream._retain(self.stderr_tail, data, self.retain)
+        if self.stderr_callback is not None:
+            self.stderr_callback(obj, data)
+
+    def _terminated(self, obj, returncode):
+        with self.cv:
+            self.returncode = returncode
+            self.cv.notify()
+
+    @staticmethod
+    def _retain(tail, data, retain):
+        # a ring buffer of sorts - keeps only the last 'retain' bytes
+        if retain <= 0:
+            return
+        tail += data
+        if len(tail) > retain:
+            del tail[:-retain]
+
+    def __repr__(self):
+        return "<ProcessStream process=%s pending=%d>" % (str(self.process), self.pending_bytes)
@@ -20,6 +20,7 @@ from .docker import Docker
 
 
 class Sender:
+    slab_size = 4 * 1024 * 1024  # uploads are sent in compressed slabs of (up to) this much data
 
     @staticmethod
     def layer_stack(descr):
@@ -73,26 +74,50 @@ class Sender:
 
             # is this one we care about?
             if sha256 in layers:
-                logging.info("Uploading: " + sha256[:16])
-
-                # send in compressed 4MB chunks
-                slab_size = 4*1024*1024
-                data_loc = 0
-                slab = 0
-                data_length = len(layer_data)
-                logging.info("Uploading slabs: " + str((data_length // slab_size) + 1))
-                while data_loc < data_length:
-                    end_byte = (slab+1) * slab_size
-                    if end_byte >= len(layer_data):
-                        end_byte = len(layer_data)
-                    send_data = lzma.compress(layer_data[data_loc:end_byte], preset=1)
-                    reply = conn.send_blocking_cmd(b'upload_slab', {'sha256': sha256, 'slab': slab}, bulk=send_data)
-                    logging.info(reply.params['log'])
-                    data_loc += slab_size
-                    slab += 1
-
-                # this is the end
-                # the upload_complete call can take ages to happen because it'll be behind all the slabs
-                msg = conn.send_blocking_cmd(b'upload_complete', {'sha256': sha256, 'slabs': slab}, timeout=300)
-                logging.info(msg.params['log'])
+                Sender.upload(sha256, layer_data, conn)
+
+    @staticmethod
+    def send_blobs(blobs, conn):
+        """Internal use: Send content addressed data (i.e. pre-boot files) to the location.
+        Passed a dictionary of sha256->data, only those the location does not already have are sent."""
+        if len(blobs) == 0:
+            return
+        for sha256 in Sender.upload_requirements(list(blobs.keys()), conn):
+            Sender.upload(sha256, blobs[sha256], conn)
+
+    @staticmethod
+    def sha256(data) -> str:
+        """Internal use: The sha256 of bytes or the contents of a binary file, the file is read in slabs."""
+        if isinstance(data, (bytes, bytearray)):
+            return hashlib.sha256(data).hexdigest()
+        hsh = hashlib.sha256()
+        data.seek(0)
+        for chunk in iter(lambda: data.read(Sender.slab_size), b''):
+            hsh.update(chunk)
+        return hsh.hexdigest()
+
+    @staticmethod
+    def upload(sha256, data, conn):
+        """Internal use: Upload a single piece of data (bytes or a binary file), identified by its sha256."""
+        logging.info("Uploading: " + sha256[:16])
+
+        # send in compressed slabs, reading a file one slab at a time
+        source = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        data_length = source.seek(0, io.SEEK_END)
+        source.seek(0)
+        slab = 0
+        logging.info("Uploading slabs: " + str((data_length // Sender.slab_size) + 1))
+        while True:
+            chunk = source.read(Sender.slab_size)
+            if len(chunk) == 0:
+                break
+            send_data = lzma.compress(chunk, preset=1)
+            reply = conn.send_blocking_cmd(b'upload_slab', {'sha256': sha256, 'slab': slab}, bulk=send_data)
+            logging.info(reply.params['log'])
+            slab += 1
+
+        # this is the end
+        # the upload_complete call can take ages to happen because it'll be behind all the slabs
+        msg = conn.send_blocking_cmd(b'upload_complete', {'sha256': sha256, 'slabs': slab}, timeout=300)
+        logging.info(msg.params['log'])
 
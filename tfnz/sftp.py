@@ -12,10 +12,20 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
 import os
+import errno
+import stat
+import time
+import posixpath
 import weakref
 import logging
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Condition, Lock, get_ident
 from paramiko import SFTPServerInterface, SFTPAttributes, SFTPHandle
-from paramiko.sftp import SFTP_OK
+from paramiko.common import DEBUG
+from paramiko.message import Message
+from paramiko.sftp import SFTP_OK, SFTP_FAILURE, CMD_CLOSE
 from paramiko.sftp_server import SFTPServer
 
 
@@ -26,13 +36,24 @@ class Sftp(SFTPServerInterface):
 
     # These are blocking commands to give the container a chance to return an exception
 
+    # Results of stat, lstat and list_folder are cached for a short while because clients (particularly GUI ones)
+    # stat everything they can see, over and over. A listing also caches the stats of the entries in it.
+    cache_ttl = 2
+
     def __init__(self, transport):
         super().__init__(transport)
         self.node_pk = transport.parent().node().pk
         self.container = weakref.ref(transport.container())
         self.conn = weakref.ref(transport.container().conn())
+        self.stats = {}  # path -> (expiry time, SFTPAttributes or error)
+        self.lstats = {}
+        self.listings = {}  # directory -> (expiry time, list of SFTPAttributes)
 
     def list_folder(self, directory):
+        directory = posixpath.normpath(directory)
+        cached = Sftp.cached(self.listings, directory)
+        if cached is not None:
+            return list(cached)
         ls = self.conn().send_blocking_cmd(b'ls_dir', {"node": self.node_pk,
                                                        "container": self.container().uuid,
                                                        "directory": directory})
@@ -40,33 +61,56 @@ class Sftp(SFTPServerInterface):
         if 'error' in ls.params:
             return SFTPServer.convert_errno(ls.params['error'])
         else:
+            expiry = time.time() + Sftp.cache_ttl
             for entry in ls.params['entries']:
                 attr = SFTPAttributes.from_stat(os.stat_result(entry[1]), entry[0])
                 rtn.append(attr)
-            return rtn
+
+                # if it's not a link then stat and lstat are the same thing
+                path = posixpath.join(directory, entry[0])
+                self.lstats[path] = (expiry, SFTPAttributes.from_stat(os.stat_result(entry[1])))
+                if not stat.S_ISLNK(attr.st_mode):
+                    self.stats[path] = self.lstats[path]
+            self.listings[directory] = (expiry, rtn)
+            return list(rtn)
 
     def stat(self, path):
-        stat = self.conn().send_blocking_cmd(b'stat_file', {"node": self.node_pk,
-                                                            "container": self.container().uuid,
-                                                            "filename": path})
-        if 'error' in stat.params:
-            return SFTPServer.convert_errno(stat.params['error'])
+        path = posixpath.normpath(path)
+        cached = Sftp.cached(self.stats, path)
+        if cached is not None:
+            return cached
+        st = self.conn().send_blocking_cmd(b'stat_file', {"node": self.node_pk,
+                                                          "container": self.container().uuid,
+                                                          "filename": path})
+        if 'error' in st.params:
+            rtn = SFTPServer.convert_errno(st.params['error'])
         else:
-            return SFTPAttributes.from_stat(os.stat_result(stat.params['stat']))
+            rtn = SFTPAttributes.from_stat(os.stat_result(st.params['stat']))
+        self.stats[path] = (time.time() + Sftp.cache_ttl, rtn)
+        return rtn
 
     def lstat(self, path):
-        stat = self.conn().send_blocking_cmd(b'lstat_file', {"node": self.node_pk,
-                                                             "container": self.container().uuid,
-                                                             "filename": path})
-        if 'error' in stat.params:
-            return SFTPServer.convert_errno(stat.params['error'])
+        path = posixpath.normpath(path)
+        cached = Sftp.cached(self.lstats, path)
+        if cached is not None:
+            return cached
+        st = self.conn().send_blocking_cmd(b'lstat_file', {"node": self.node_pk,
+                                                           "container": self.container().uuid,
+                                                           "filename": path})
+        if 'error' in st.params:
+            rtn = SFTPServer.convert_errno(st.params['error'])
         else:
-            return SFTPAttributes.from_stat(os.stat_result(stat.params['lstat']))
+            rtn = SFTPAttributes.from_stat(os.stat_result(st.params['lstat']))
+        self.lstats[path] = (time.time() + Sftp.cache_ttl, rtn)
+        return rtn
 
     def open(self, path, flags, attr):
-        return SftpFile(flags, self.node_pk, self.container, path)
+        if flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC):
+            self.invalidate(path)
+        return SftpFile(flags, self.node_pk, self.container, path, weakref.ref(self))
 
     def remove(self, path):
+        self.invalidate(path)
         rm = self.conn().send_blocking_cmd(b'rm_file', {"node": self.node_pk,
                                                         "container": self.container().uuid,
                                                         "filename": path})
@@ -76,6 +120,8 @@ class Sftp(SFTPServerInterface):
             return SFTP_OK
 
     def rename(self, path, newpath):
+        self.invalidate(path, True)
+        self.invalidate(newpath, True)
         mv = self.conn().send_blocking_cmd(b'mv_file', {"node": self.node_pk,
                                                         "container": self.container().uuid,
                                                         "filename": path,
@@ -86,6 +132,7 @@ class Sftp(SFTPServerInterface):
             return SFTP_OK
 
     def mkdir(self, path, attr):
+        self.invalidate(path)
         md = self.conn().send_blocking_cmd(b'mk_dir', {"node": self.node_pk,
                                                        "container": self.container().uuid,
                                                        "directory": path})
@@ -95,6 +142,7 @@ class Sftp(SFTPServerInterface):
             return SFTP_OK
 
     def rmdir(self, path):
+        self.invalidate(path, True)
         rm = self.conn().send_blocking_cmd(b'rm_dir', {"node": self.node_pk,
                                                        "container": self.container().uuid,
                                                        "directory": path})
@@ -103,37 +151,314 @@ class Sftp(SFTPServerInterface):
         else:
             return SFTP_OK
 
+    def invalidate(self, path, recursive=False):
+        # forget what we know about a path, the directory it's in and (optionally) everything underneath it
+        path = posixpath.normpath(path)
+        for cache in (self.stats, self.lstats, self.listings):
+            cache.pop(path, None)
+        self.listings.pop(posixpath.dirname(path), None)
+        if recursive:
+            prefix = path.rstrip('/') + '/'
+            for cache in (self.stats, self.lstats, self.listings):
+                for key in [key for key in list(cache.keys()) if key.startswith(prefix)]:
+                    cache.pop(key, None)
+
+    @staticmethod
+    def cached(cache, key):
+        try:
+            expiry, value = cache[key]
+        except KeyError:
+            return None
+        if expiry < time.time():
+            cache.pop(key, None)
+            return None
+        return value
+
     def __repr__(self):
         return "<tfnz.sftp.Sftp object at %x (container=%s)>" % (id(self), self.container().uuid.decode())
 
 
+class SftpServer(SFTPServer):
+    """The paramiko sftp server, but handling requests concurrently and reporting errors from closing a file
+    (i.e. a failed write) back to the client.
+
+    Paramiko handles one request at a time, and since each one is a round trip to the location a client that
+    pipelines requests gets no benefit. Here requests are handed to a pool of threads as they arrive and
+    responses are sent as they complete. Requests for the same handle (or path) are still handled in the order
+    they arrived."""
+    workers = 16
+
+    def __init__(self, channel, name, server, sftp_si=SFTPServerInterface, *args, **kwargs):
+        super().__init__(channel, name, server, sftp_si, *args, **kwargs)
+        self.executor = None
+        self.worker_threads = set()  # idents of the executor's threads, recorded as they run requests
+        self.strands = {}  # handle or path -> deque of requests waiting for the one in progress to complete
+        self.strands_lock = Lock()
+        self.send_lock = Lock()
+        self.handle_lock = Lock()
+
+    def start_subsystem(self, name, transport, channel):
+        self.sock = channel
+        self._log(DEBUG, "Started sftp server on channel {!r}".format(channel))
+        self._send_server_version()
+        self.server.session_started()
+        self.executor = ThreadPoolExecutor(max_workers=SftpServer.workers)
+        try:
+            while True:
+                try:
+                    t, data = self._read_packet()
+                except EOFError:
+                    self._log(DEBUG, "EOF -- end of session")
+                    return
+                except Exception as e:
+                    self._log(DEBUG, "Exception on channel: " + str(e))
+                    return
+                msg = Message(data)
+                request_number = msg.get_int()
+                self._dispatch(SftpServer._strand_key(msg), (t, request_number, msg))
+        finally:
+            self.executor.shutdown(wait=True)
+            # each worker had its own socket for talking to the location, the threads have gone so close them
+            conn = self.server.conn()
+            if conn is not None:
+                for thread in self.worker_threads:
+                    conn.destroy_send_skt_for(thread)
+            self.worker_threads.clear()
+
+    @staticmethod
+    def _strand_key(msg):
+        # almost every request starts with either a handle or a path
+        position = msg.packet.tell()
+        try:
+            return msg.get_binary()
+        except Exception:
+            return None
+        finally:
+            msg.packet.seek(position)
+
+    def _dispatch(self, key, request):
+        if key is not None:
+            with self.strands_lock:
+                if key in self.strands:
+                    self.strands[key].append(request)  # runs after the one in progress
+                    return
+                self.strands[key] = deque()
+        self.executor.submit(self._run_strand, key, request)
+
+    def _run_strand(self, key, request):
+        # runs the request then any others that arrived for the same key in the meantime
+        with self.strands_lock:
+            self.worker_threads.add(get_ident())
+        while True:
+            self._process_safely(*request)
+            if key is None:
+                return
+            with self.strands_lock:
+                if len(self.strands[key]) == 0:
+                    del self.strands[key]
+                    return
+                request = self.strands[key].popleft()
+
+    def _process_safely(self, t, request_number, msg):
+        try:
+            self._process(t, request_number, msg)
+        except Exception as e:
+            self._log(DEBUG, "Exception in server processing: " + str(e))
+            try:
+                self._send_status(request_number, SFTP_FAILURE)
+            except Exception:
+                pass
+
+    def _send_packet(self, t, packet):
+        with self.send_lock:
+            super()._send_packet(t, packet)
+
+    def _send_handle_response(self, request_number, handle, folder=False):
+        with self.handle_lock:  # allocating the handle name is not thread safe
+            super()._send_handle_response(request_number, handle, folder)
+
+    def _process(self, t, request_number, msg):
+        if t == CMD_CLOSE:
+            position = msg.packet.tell()
+            handle = msg.get_binary()
+            if handle in self.file_table:
+                rtn = self.file_table[handle].close()
+                del self.file_table[handle]
+                self._send_status(request_number, rtn)
+                return
+            msg.packet.seek(position)
+        super()._process(t, request_number, msg)
+
+
 class SftpFile(SFTPHandle):
     """Proxy object for an actual file"""
-    def __init__(self, flags, node_pk, container, filename):
+    # Reads are fetched a block at a time and cached. Sequential reads fetch further ahead each time.
+    block_size = 256 * 1024
+    max_read_ahead = 4 * 1024 * 1024
+    cache_blocks = 64  # so at most 16MB per open file
+
+    # Sequential writes are gathered into chunks and sent without waiting for each to complete.
+    # Errors are returned from the next write or from close.
+    write_chunk = 1024 * 1024
+    max_in_flight = 8 * 1024 * 1024
+
+    def __init__(self, flags, node_pk, container, filename, sftp=None):
         super().__init__(flags)
         logging.debug("Opened a file via sftp: " + filename)
         self.node_pk = node_pk
         self.container = container
         self.filename = filename
-        try:
-            self.data = bytearray(container().fetch(filename))
-            logging.debug("...retrieved file: " + filename)
-        except ValueError:
-            self.data = bytearray()
-            logging.debug("...will create new file on writing: " + filename)
+        self.sftp = sftp  # so writes can invalidate the attribute cache
+        self.blocks = OrderedDict()  # block number -> bytes, least recently used first
+        self.size = None  # known once we've read the last block
+        self.next_offset = 0
+        self.read_ahead = SftpFile.block_size
+        self.whole = None  # if the location can't fetch ranges we get the whole file instead
+        self.pending = bytearray()  # written but not sent yet
+        self.pending_offset = 0
+        self.in_flight = 0  # bytes sent but not acknowledged
+        self.in_flight_changed = Condition()
+        self.error = None
 
     def read(self, offset, length):
-        mv = memoryview(self.data)
-        return bytes(mv[offset:offset+length])
+        # make sure we read back what was written
+        if len(self.pending) != 0 or self.in_flight != 0:
+            self.wait_written()
+
+        # the whole file?
+        if self.whole is not None:
+            return bytes(memoryview(self.whole)[offset:offset+length])
+
+        # sequential reads open up the read ahead, random reads close it down again
+        if offset == self.next_offset:
+            self.read_ahead = min(self.read_ahead * 2, SftpFile.max_read_ahead)
+        else:
+            self.read_ahead = SftpFile.block_size
+        self.next_offset = offset + length
+
+        # assemble from blocks
+        rtn = []
+        while length > 0 and (self.size is None or offset < self.size):
+            number = offset // SftpFile.block_size
+            try:
+                block = self.block(number)
+            except ValueError:
+                return SFTPServer.convert_errno(errno.ENOENT)
+            if self.whole is not None:
+                return b''.join(rtn) + bytes(memoryview(self.whole)[offset:offset+length])
+            start = offset - number * SftpFile.block_size
+            if start >= len(block):
+                break  # end of file
+            data = block[start:start+length]
+            rtn.append(data)
+            offset += len(data)
+            length -= len(data)
+        return b''.join(rtn)
+
+    def block(self, number):
+        # returns the block from cache or fetches it along with any read ahead
+        try:
+            self.blocks.move_to_end(number)
+            return self.blocks[number]
+        except KeyError:
+            pass
+        offset = number * SftpFile.block_size
+        length = self.read_ahead
+        data = self.container().fetch(self.filename, offset=offset, length=length)
+
+        # did the location ignore the range?
+        if len(data) > length:
+            logging.debug("...location returned the whole file: " + self.filename)
+            self.whole = bytearray(data)
+            self.blocks.clear()
+            return b''
+
+        # a short read means we now know where the file ends
+        if len(data) < length:
+            self.size = offset + len(data)
+
+        # split into cache blocks
+        first = None
+        mv = memoryview(data)
+        for start in range(0, max(len(data), 1), SftpFile.block_size):
+            block = bytes(mv[start:start+SftpFile.block_size])
+            self.blocks[number + start // SftpFile.block_size] = block
+            if first is None:
+                first = block
+        while len(self.blocks) > SftpFile.cache_blocks:
+            self.blocks.popitem(last=False)
+        return first
 
     def write(self, offset, data):
-        self.data[offset:offset+len(data)] = data
-        self.container().conn().send_blocking_cmd(b'write_file', {"node": self.node_pk,
-                                                                  "container": self.container().uuid,
-                                                                  "filename": self.filename,
-                                                                  "offset": offset}, bulk=data)
+        if self.error is not None:
+            return self.error
+
+        # forget anything we'd read from where the write lands
+        if self.whole is not None:
+            self.whole[offset:offset+len(data)] = data
+        first = offset // SftpFile.block_size
+        last = (offset + len(data)) // SftpFile.block_size
+        for number in range(first, last + 1):
+            self.blocks.pop(number, None)
+        if self.size is not None:
+            self.size = max(self.size, offset + len(data))
+
+        # gather sequential writes
+        if len(self.pending) != 0 and offset != self.pending_offset + len(self.pending):
+            self.send_pending()
+        if len(self.pending) == 0:
+            self.pending_offset = offset
+        self.pending += data
+        if len(self.pending) >= SftpFile.write_chunk:
+            self.send_pending()
+        if self.sftp is not None and self.sftp() is not None:
+            self.sftp().invalidate(self.filename)
         return SFTP_OK
 
+    def send_pending(self):
+        if len(self.pending) == 0:
+            return
+        data = bytes(self.pending)
+        offset = self.pending_offset
+        self.pending.clear()
+        self.pending_offset += len(data)
+
+        # wait for room in the window
+        with self.in_flight_changed:
+            if not self.in_flight_changed.wait_for(
+                    lambda: self.in_flight == 0 or self.in_flight + len(data) <= SftpFile.max_in_flight, 240):
+                logging.warning("Timed out waiting to write to: " + self.filename)
+                self.error = SFTP_FAILURE
+                return
+            self.in_flight += len(data)
+        self.container().conn().send_cmd(b'write_file', {"node": self.node_pk,
+                                                         "container": self.container().uuid,
+                                                         "filename": self.filename,
+                                                         "offset": offset}, bulk=data,
+                                         reply_callback=partial(self._written, len(data)))
+
+    def _written(self, length, msg):
+        # on the message loop
+        self.container().conn().loop.unregister_reply(msg.uuid)
+        if 'exception' in msg.params:
+            logging.warning("Failed writing to %s: %s" % (self.filename, msg.params['exception']))
+            self.error = SFTP_FAILURE
+        with self.in_flight_changed:
+            self.in_flight -= length
+            self.in_flight_changed.notify_all()
+
+    def wait_written(self):
+        self.send_pending()
+        with self.in_flight_changed:
+            if not self.in_flight_changed.wait_for(lambda: self.in_flight == 0, 240):
+                logging.warning("Timed out waiting for writes to complete: " + self.filename)
+                self.error = SFTP_FAILURE
+
     def close(self):
         logging.debug("Closed a file via sftp: " + self.filename)
-        return SFTP_OK
+        self.wait_written()
+        if self.sftp is not None and self.sftp() is not None:
+            self.sftp().invalidate(self.filename)
+        self.blocks.clear()
+        self.whole = None
+        return SFTP_OK if self.error is None else self.error
@@ -21,10 +21,12 @@ import paramiko.ssh_exception
 import logging
 import shortuuid
 import re
-from threading import Thread
-from .sftp import Sftp
+from threading import Event, Lock
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from .sftp import Sftp, SftpServer
 from . import Waitable
-from .tunnel import Tunnel
+from .tunnel import Tunnel, ReverseTunnel, Proxy
 
 
 class SshServer(Waitable):
@@ -33,93 +35,133 @@ class SshServer(Waitable):
     Note that for the purposes of this, tunnels are regarded as processes because it makes loads of things simpler.
 
     Do not instantiate directly, use container.create_ssh_server"""
+    host_keys = None  # loaded (or generated) once per process and shared by every server
+    host_keys_lock = Lock()
 
-    def __init__(self, container, port):
+    def __init__(self, container, port, fast_exec=False):
         Waitable.__init__(self)
         self.uuid = shortuuid.uuid()
         self.container = weakref.ref(container)
         self.node = weakref.ref(container.parent())
         self.location = weakref.ref(self.node().parent())
+        self.loop = weakref.ref(container.conn().loop)
         self.port = port
-        self.run_thread = None
-        self.stopping = False
+        self.fast_exec = fast_exec
         self.transports = {}  # id to object
 
-        # get a host key
-        host_key_fname = os.path.expanduser('~/.20ft/host_key')
-        try:
-            self.host_key = paramiko.RSAKey.from_private_key_file(host_key_fname)
-        except FileNotFoundError:
-            self.host_key = paramiko.rsakey.RSAKey.generate(1024)
-            self.host_key.write_private_key_file(host_key_fname)
+        # get the host keys
+        self.host_keys = SshServer.load_host_keys()
 
         # see if we can bring the socket up
         self.sock = socket.socket()
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.setblocking(False)
         self.sock.bind(('', self.port))
 
         # we are good to go
         self.sock.listen()
         logging.info("SSH server listening: ssh -p %s root@localhost" % self.port)
 
+    @staticmethod
+    def load_host_keys() -> list:
+        # Ed25519 is much cheaper per handshake than RSA so is offered first,
+        # the RSA key is kept so clients that already know it don't see the host key change
+        with SshServer.host_keys_lock:
+            if SshServer.host_keys is not None:
+                return SshServer.host_keys
+
+            ed25519_fname = os.path.expanduser('~/.20ft/host_key_ed25519')
+            try:
+                ed25519_key = paramiko.Ed25519Key.from_private_key_file(ed25519_fname)
+            except FileNotFoundError:
+                pem = Ed25519PrivateKey.generate().private_bytes(serialization.Encoding.PEM,
+                                                                 serialization.PrivateFormat.OpenSSH,
+                                                                 serialization.NoEncryption())
+                with os.fdopen(os.open(ed25519_fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+                    f.write(pem)
+                ed25519_key = paramiko.Ed25519Key.from_private_key_file(ed25519_fname)
+
+            rsa_fname = os.path.expanduser('~/.20ft/host_key')
+            try:
+                rsa_key = paramiko.RSAKey.from_private_key_file(rsa_fname)
+            except FileNotFoundError:
+                rsa_key = paramiko.rsakey.RSAKey.generate(2048)
+                rsa_key.write_private_key_file(rsa_fname)
+
+            SshServer.host_keys = [ed25519_key, rsa_key]
+            return SshServer.host_keys
+
     def start(self):
-        # creates the run loop on a separate thread
-        self.run_thread = Thread(target=self.run, name="SSH server onto: " + self.container().uuid.decode())
-        self.run_thread.start()
+        # accepts are driven by the message loop
+        self.loop().register_exclusive(self.sock.fileno(), self.event,
+                                       comment="SSH server onto: " + self.container().uuid.decode())
         self.mark_as_ready()
 
     def stop(self):
+        # stop accepting
+        self.loop().unregister_exclusive(self.sock.fileno())
+
         # close the transports
         for transport in list(self.transports.values()):
             transport.stop()
-
-        # close our own accept loop
-        self.stopping = True
-        self.run_thread.join()
         self.sock.close()
 
-    def run(self):
-        # an accept loop
-        self.sock.settimeout(0.5)  # so we can poll for self.stopping
-        while not self.stopping:
+    def event(self, fd):
+        # accept every connection that is waiting, the ssh negotiation happens on paramiko's thread
+        while True:
             try:
-                # accept a new connection or poll
-                try:
-                    client, addr = self.sock.accept()
-                except socket.timeout:
-                    continue
-
-                # wrap a transport round it
-                transport = SshTransport(self, client, self.host_key)
-                self.transports[transport.uuid] = transport
-
-            except EOFError:
-                raise ValueError("There was a problem with ssh - Is there an old key in 'known_hosts'?")
-
-        logging.debug("Exiting server accept loop")
+                client, addr = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning("SSH server failed to accept a connection: " + str(e))
+                return
+            client.setblocking(True)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # exit status, eof and close go together
+            transport = SshTransport(self, client, self.host_keys)
+            self.transports[transport.uuid] = transport
 
     def transport_closed(self, transport):
         logging.debug("SSH server knows transport has closed: " + transport.uuid)
-        del self.transports[transport.uuid]
+        self.transports.pop(transport.uuid, None)
 
     def __repr__(self):
         return "<SshServer '%s' container=%s port=%d>" % \
                (self.uuid, self.container().uuid.decode(), self.port)
 
 
+class ParamikoTransport(paramiko.Transport):
+    """A paramiko transport that calls back when a channel opens and when it finishes,
+    rather than needing a thread blocked in accept."""
+
+    def __init__(self, skt, channel_callback, closed_callback, **kwargs):
+        super().__init__(skt, **kwargs)
+        self.channel_callback = channel_callback
+        self.closed_callback = closed_callback
+
+    def _queue_incoming_channel(self, channel):
+        # on paramiko's thread, before any requests for the channel are processed
+        self.channel_callback(channel)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.closed_callback()
+
+
 class SshTransport(paramiko.ServerInterface):
     """A Transport is the per-client abstraction, it will spawn channels."""
+    window_size = 8 * 1024 * 1024  # paramiko's default 2MB stalls forwards between acknowledgements
+    max_packet_size = 256 * 1024  # lets clients send fewer, larger packets
 
-    def __init__(self, parent, skt, host_key):
+    def __init__(self, parent, skt, host_keys):
         self.uuid = shortuuid.uuid()
         self.parent = weakref.ref(parent)
         self.container = weakref.ref(parent.container())
         self.lead_channel = None
         self.socket = skt
-        self.paramiko_transport = paramiko.Transport(skt)
-        self.paramiko_transport.add_server_key(host_key)
-        self.paramiko_transport.set_subsystem_handler('sftp', paramiko.SFTPServer, Sftp)
-        self.paramiko_transport.start_server(server=self)  # for this one connection
+        self.authenticated = False
 
         # channels and port forwarding
         self.channels = {}  # ssh channel id to SshChannel
@@ -129,72 +171,84 @@ class SshTransport(paramiko.ServerInterface):
         self.pending_tunnels = {}  # ssh channel id to list of port numbers
         self.pending_reverses = []  # a list of reverse objects
 
-        # start the transport's accept loop
-        self.accept_thread = Thread(target=self.channel_accept, name="SSH transport: " + self.uuid)
-        self.accept_thread.start()
-
-    def channel_accept(self):
-        # a per-transport accept loop
-        close_callback = self.stop
-        while True:
-            channel = self.paramiko_transport.accept()
-
-            # is the transport closing down?
-            if channel is None:
-                break  # breaks the loop
-
-            # otherwise we're all good
-            chid = channel.get_id()
-            logging.debug("Accepted paramiko channel: " + str(chid))
-            ssh_channel = SshChannel(channel, self.container(), close_callback)
-            if close_callback is not None:  # is the leader channel
-                self.lead_channel = ssh_channel
-            self.channels[chid] = ssh_channel
-            close_callback = None
-
-            # waiting to spawn forward tunnels?
-            if chid in self.pending_tunnels:
-                for port in self.pending_tunnels[chid]:
-                    logging.debug("Spawning pending forward for port: " + str(port))
-                    ssh_channel.spawn_tunnel(port)  # can only happen after .accept has happened
-                del self.pending_tunnels[chid]
-
-            # waiting to spawn channels for reverse tunnels?
-            # keeps track of it's own child tunnels
-            for reverse in self.pending_reverses:
-                try:
-                    logging.debug("Hooking up pending reverse for port: " + str(reverse.dest_addr[1]))
-                    reverse.spawn_channel()
-                    self.reverses[reverse.dest_addr[1]] = reverse
-                except ValueError as e:
-                    logging.warning(e)
-            self.pending_reverses.clear()
-
-        # exited the loop
-        logging.debug("Transport loop exited for: " + self.uuid)
-
-        # let the parent know we're done
-        self.parent().transport_closed(self)
+        # start paramiko, it runs the negotiation on it's own thread and calls back as channels are opened
+        self.paramiko_transport = ParamikoTransport(skt, self.channel_opened, self.transport_closed,
+                                                    default_window_size=SshTransport.window_size,
+                                                    default_max_packet_size=SshTransport.max_packet_size)
+        for host_key in host_keys:
+            self.paramiko_transport.add_server_key(host_key)
+        self.paramiko_transport.set_subsystem_handler('sftp', SftpServer, Sftp)
+        self.paramiko_transport.start_server(server=self, event=Event())  # for this one connection
+
+    # A transport can carry any number of channels (i.e. with ControlMaster on the client),
+    # closing a channel leaves the transport open and it is left to the client to disconnect.
+    def channel_opened(self, channel):
+        # paramiko has opened a channel
+        chid = channel.get_id()
+        logging.debug("Accepted paramiko channel: " + str(chid))
+        ssh_channel = SshChannel(channel, self.container(), self.channel_closed)
+        if self.lead_channel is None:
+            self.lead_channel = ssh_channel  # for reporting problems
+        self.channels[chid] = ssh_channel
+
+        # waiting to spawn forward tunnels?
+        if chid in self.pending_tunnels:
+            for port in self.pending_tunnels[chid]:
+                logging.debug("Spawning pending forward for port: " + str(port))
+                ssh_channel.spawn_tunnel(port)  # can only happen after the channel has been created
+            del self.pending_tunnels[chid]
+
+        # waiting to spawn channels for reverse tunnels?
+        # keeps track of it's own child tunnels
+        for reverse in self.pending_reverses:
+            try:
+                logging.debug("Hooking up pending reverse for port: " + str(reverse.dest_addr[1]))
+                reverse.spawn_channel()
+                self.reverses[reverse.dest_addr[1]] = reverse
+            except ValueError as e:
+                logging.warning(e)
+        self.pending_reverses.clear()
+
+    def channel_closed(self, channel):
+        self.channels.pop(channel.get_id(), None)
+        if channel is self.lead_channel:
+            self.lead_channel = next(iter(self.channels.values()), None)
+
+    def transport_closed(self):
+        # paramiko's thread has exited
+        logging.debug("Transport thread exited for: " + self.uuid)
+        if not self.authenticated and isinstance(self.paramiko_transport.saved_exception, EOFError):
+            logging.warning("There was a problem with ssh - Is there an old key in 'known_hosts'? (%s)" %
+                            str(self.paramiko_transport.saved_exception))
+
+        # the client went away, so clear up anything it left running
+        if self.socket is not None:
+            self.socket = None
+            self.close_channels()
+        if self.parent() is not None:
+            self.parent().transport_closed(self)
 
     def stop(self):
         if self.socket is None:
             return
+        self.socket = None
+        self.close_channels()
 
+        # close down the transport
+        self.paramiko_transport.close()
+        logging.debug("Transport closed for: " + self.uuid)
+
+    def close_channels(self):
         # do reverses first because they will hold open processes in sessions
-        for reverse in list(self.reverses.values()):
+        for reverse in list(self.reverses.values()) + self.pending_reverses:
             reverse.close()
+        self.pending_reverses.clear()
         for channel in list(self.channels.values()):
-            channel.close_callback = None
             channel.close()
 
-        # close down the transport
-        self.accept_thread.join()
-        self.paramiko_transport.close()
-        self.socket = None
-        logging.debug("Transport closed for: " + self.uuid)
-
     # Paramiko authentication (or lack thereof)
     def check_auth_none(self, username):
+        self.authenticated = True
         return paramiko.AUTH_SUCCESSFUL
 
     def get_allowed_auths(self, username):
@@ -228,10 +282,9 @@ class SshTransport(paramiko.ServerInterface):
         return port
 
     # Callbacks across the server interface
+    # The channel is always in self.channels by now because paramiko calls back as it's opened
     def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
-        # an occasional race condition
-        while not channel.get_id() in self.channels:
-            os.sched_yield()
+        self.channels[channel.get_id()].pty = True
         self.channels[channel.get_id()].set_pty_dimensions(width, height)
         return True
 
@@ -242,18 +295,18 @@ class SshTransport(paramiko.ServerInterface):
         return True
 
     def check_channel_exec_request(self, channel, command):
-        while not channel.get_id() in self.channels:
-            os.sched_yield()
-        return self.channels[channel.get_id()].spawn_process(command)
+        ssh_channel = self.channels[channel.get_id()]
+        if self.parent().fast_exec and not ssh_channel.pty:
+            return ssh_channel.run_process(command)
+        return ssh_channel.spawn_process(command)
 
     def check_channel_shell_request(self, channel):
-        while not channel.get_id() in self.channels:
-            os.sched_yield()
         return self.channels[channel.get_id()].spawn_shell()
 
 
 class SshChannel:
     """A channel is a single channel through a transport. It can be connected to only one process."""
+    max_read = Proxy.max_read  # the most we will pass on in a single message
 
     def __init__(self, paramiko_channel, container, close_callback=None):
         self.paramiko_channel = paramiko_channel
@@ -265,42 +318,39 @@ class SshChannel:
         self.width = 80
         self.height = 24
         self.process = None  # only one process
-        self.close_callback = close_callback
+        self.pty = False
+        self.chid = paramiko_channel.get_id()
+        self.close_callback = close_callback  # called with this channel once it has closed
 
     def close(self, obj=None, returncode=0):  # signature needs to be this for callback to work
         # if we've been closed already, just skip out
         if self.paramiko_channel is None:
             return
 
-        # has this been created with a callback?
-        if self.close_callback is not None:
-            logging.debug("Closing lead channel.")
-            cc = self.close_callback
-            self.close_callback = None
-            cc()
-            return
-
         # close the channel
-        chid = self.paramiko_channel.get_id()
-        fd = self.paramiko_channel.fileno()
-        logging.debug("[chan %d] closing" % chid)
-
-        self.paramiko_channel.send_exit_status(returncode)
-        self.paramiko_channel.shutdown(2)
-        self.paramiko_channel.close()
+        channel = self.paramiko_channel
         self.paramiko_channel = None
+        fd = channel.fileno()
+        logging.debug("[chan %d] closing" % self.chid)
         if fd in self.loop().exclusive_handlers:
             self.loop().unregister_exclusive(fd)
+        try:
+            channel.send_exit_status(returncode)
+            channel.shutdown(2)
+            channel.close()
+        except (OSError, EOFError):
+            logging.debug("[chan %d] transport had already gone" % self.chid)
+        if self.close_callback is not None:
+            self.close_callback(self)
 
         # close the process (they aren't tied into the container in this case)
         if self.process is not None:
-            if self.process.uuid in self.location().tunnels:
-                del self.location().tunnels[self.process.uuid]
+            self.location().remove_tunnel(self.process)
             if not self.process.dead:
                 self.process.destroy()
 
     def get_id(self):
-        return self.paramiko_channel.get_id()
+        return self.chid
 
     # events coming in from the transport
 
@@ -316,23 +366,46 @@ class SshChannel:
                                                    'width': self.width,
                                                    'height': self.height})
 
+    # The channel is hooked into the loop before the process is spawned.
+    # A process that exits straight away closes the channel, which needs to find it already hooked in.
     def spawn_process(self, command):
         # spawn the process on the end of this channel
+        self.loop().register_exclusive(self.paramiko_channel.fileno(), self.event,
+                                       comment="SSH Process " + command.decode())
         self.process = self.container().spawn_process(command.decode(),
                                                       data_callback=self.data,
                                                       stderr_callback=self.stderr,
                                                       termination_callback=self.close)
-        self.loop().register_exclusive(self.paramiko_channel.fileno(), self.event,
-                                       comment="SSH Process " + self.process.uuid.decode())
         return True
 
+    def run_process(self, command):
+        # the fast path: a single round trip, but no stdin
+        self.connection().send_cmd(b'run_process', {'node': self.node().pk,
+                                                    'container': self.container().uuid,
+                                                    'command': command.decode()},
+                                   reply_callback=self.process_ran)
+        return True
+
+    def process_ran(self, msg):
+        self.loop().unregister_reply(msg.uuid)
+        if self.paramiko_channel is None:
+            return  # the client gave up waiting
+        if 'exception' in msg.params:
+            self.stderr(self, str(msg.params['exception']).encode() + b'\n')
+            self.close(returncode=1)
+            return
+        if len(msg.params['stdout']) != 0:
+            self.data(self, msg.params['stdout'])
+        if len(msg.params['stderr']) != 0:
+            self.stderr(self, msg.params['stderr'])
+        self.close(returncode=int(msg.params['exit_code']))
+
     def spawn_shell(self):
         # spawn the process on the end of this channel
+        self.loop().register_exclusive(self.paramiko_channel.fileno(), self.event, comment="SSH Shell")
         self.process = self.container().spawn_shell(data_callback=self.data,
                                                     termination_callback=self.close,
                                                     echo=True)
-        self.loop().register_exclusive(self.paramiko_channel.fileno(), self.event,
-                                       comment="SSH Shell " + self.process.uuid.decode())
         self.send_window_change()
         return True
 
@@ -341,7 +414,7 @@ class SshChannel:
         tunnel = Tunnel(self.connection(), self.node(), self.container(), port)
         tunnel.connect_tcpip_direct(self)  # gets the tunnel to send the data here instead of creating tcp sockets
         self.process = tunnel
-        self.location().tunnels[tunnel.uuid] = tunnel  # needs this so 'close proxy' events are handled properly
+        self.location().add_tunnel(tunnel)  # needs this so 'close proxy' events are handled properly
         self.loop().register_exclusive(self.paramiko_channel.fileno(), self.event,
                                        comment="SSH Tunnel " + self.process.uuid.decode())
 
@@ -349,39 +422,101 @@ class SshChannel:
 
     def data(self, obj, data):
         # from remote
-        # if len(data) > 3:
-        #     logging.debug("[chan %d] <== %s" % (self.paramiko_channel.get_id(), data.decode()))
+        # paramiko slices what's left after each packet, so a memoryview saves copying the remainder every time
+        if self.paramiko_channel is None:
+            return
         try:
-            self.paramiko_channel.sendall(data)
+            self.paramiko_channel.sendall(memoryview(data))
         except OSError:
-            logging.debug("[chan %d] Failed to send: %s" % (self.paramiko_channel.get_id(), data.decode()))
+            logging.debug("[chan %d] Failed to send: %s" % (self.chid, data.decode()))
 
     def stderr(self, obj, data):
-        logging.debug("[chan %d - stderr] <== %s" % (self.paramiko_channel.get_id(), data.decode()))
+        logging.debug("[chan %d - stderr] <== %s" % (self.chid, data.decode()))
+        if self.paramiko_channel is None:
+            return
         try:
             self.paramiko_channel.sendall_stderr(data)
         except OSError:
-            logging.debug("[chan %d - stderr] Failed to send: %s" % (self.paramiko_channel.get_id(), data.decode()))
+            logging.debug("[chan %d - stderr] Failed to send: %s" % (self.chid, data.decode()))
 
     def event(self, fd):
         # A file descriptor is triggered on 'our' side
-        while self.paramiko_channel.recv_ready():
-            data = self.paramiko_channel.recv(8192)  # fits inside a jumbo frame at the other end
-            # if len(data) > 3:
-            #     logging.debug("[chan %d] ==> %s" % (self.paramiko_channel.get_id(), data.decode()))
-            self.process.stdin(data)
+        # take everything paramiko has buffered (up to a cap) and pass it on as a single message
+        channel = self.paramiko_channel
+        if channel is None or self.process is None:
+            return  # closed, or not quite started
+
+        # the client has closed the channel or will send no more
+        if channel.closed:
+            self.close()
+            return
+        if channel.eof_received and not channel.recv_ready():
+            # a half close - the far end may still reply, so wait for it (or the process) to close the channel
+            self.loop().unregister_exclusive(fd)  # otherwise paramiko leaves it readable forever
+            return
+        chunks = []
+        length = 0
+        while length < SshChannel.max_read and channel.recv_ready():
+            data = channel.recv(SshChannel.max_read - length)
+            chunks.append(data)
+            length += len(data)
+        if length == 0:
+            return
+        self.process.stdin(chunks[0] if len(chunks) == 1 else b''.join(chunks))
 
 
 class SshReverse:
+    """A remote forward (ssh -R). The location listens inside the container and hands over each connection
+    through a reverse tunnel. Locations that don't advertise 'reverse_tunnel' (or can't listen on the port)
+    get a socat process inside the container instead, with a new process for every connection."""
     socat_re = re.compile(b'^\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2} socat')
 
     def __init__(self, dest_addr, container, transport):
         # init
         self.dest_addr = dest_addr
         self.container = weakref.ref(container)
+        self.location = weakref.ref(container.parent().parent())
         self.transport = weakref.ref(transport)  # needed for open_forwarded_tcpip_channel
         self.process_channel = {}
-        self.listening_process = self.spawn_socat()
+        self.listening_process = None
+        self.tunnel = None
+        # an older location would never reply to create_reverse_tunnel, so only ask if it said it could
+        if 'reverse_tunnel' in self.location().capabilities:
+            try:
+                self.tunnel = self.spawn_tunnel()
+            except ValueError as e:
+                logging.debug("Reverse tunnel refused, falling back to socat (%s)" % str(e))
+        if self.tunnel is None:
+            self.listening_process = self.spawn_socat()
+
+    def spawn_tunnel(self):
+        logging.debug("Spawning reverse tunnel for port: " + str(self.dest_addr[1]))
+        container = self.container()
+        tunnel = ReverseTunnel(container.conn(), container.parent(), container, self.dest_addr[1], self)
+        self.location().add_tunnel(tunnel)  # so proxy messages find it
+        try:
+            tunnel.connect()
+        except ValueError:
+            self.location().destroy_tunnel(tunnel, with_command=False)
+            raise
+        return tunnel
+
+    def reverse_accepted(self, proxy):
+        # a connection has been accepted inside the container, open a channel back to the client for it
+        src_addr = ('127.0.0.1', self.dest_addr[1])
+        try:
+            p_channel = self.transport().paramiko_transport.open_forwarded_tcpip_channel(src_addr, self.dest_addr)
+        except (paramiko.ssh_exception.SSHException, EOFError):
+            logging.warning("Failed to connect reverse channel onto port: " + str(self.dest_addr[1]))
+            return False
+        channel = SshChannel(p_channel, self.container())
+        channel.process = proxy
+        proxy.data_callback = channel.data
+        proxy.termination_callback = channel.close
+        channel.loop().register_exclusive(p_channel.fileno(), channel.event,
+                                          comment="SSH Reverse " + proxy.uuid.decode())
+        logging.debug("[chan %d] opened to port: %d" % (channel.get_id(), self.dest_addr[1]))
+        return True
 
     def spawn_socat(self):
         # spawn the process that will receive connections inside the container
@@ -393,6 +528,10 @@ class SshReverse:
                                               stderr_callback=self.stderr)
 
     def spawn_channel(self):
+        # channels for a reverse tunnel are opened as connections arrive
+        if self.tunnel is not None:
+            return
+
         # does the channel exist already? (set up as part of pending)
         if self.listening_process in self.process_channel:
             return
@@ -441,6 +580,9 @@ class SshReverse:
 
     def close(self):
         logging.debug("Closing processes for SSH reverse tunnel on port: " + str(self.dest_addr[1]))
+        if self.tunnel is not None:
+            self.location().destroy_tunnel(self.tunnel)
+            self.tunnel = None
         for process in list(self.process_channel.keys()):
             process.destroy()
         if self.listening_process is not None:
@@ -472,5 +614,6 @@ class SshReverse:
 
     def fail_words(self, words):
         # echo the failure message down the ssh session's lead channel if possible
-        self.transport().lead_channel.stderr(self, words.encode() + b'\r\n')
+        if self.transport().lead_channel is not None:
+            self.transport().lead_channel.stderr(self, words.encode() + b'\r\n')
         logging.warning(words)
@@ -15,11 +15,17 @@
 # A tunnel logically goes from localhost:port to container:port but has no TCP connections
 # The tunnel is made from zero or more proxies which do the actual tunnelling
 
+import errno
 import logging
+import os
 import socket
+import stat
 import time
 import shortuuid
 import weakref
+import zmq
+from collections import deque
+from typing import Optional
 from . import Killable
 
 
@@ -27,10 +33,13 @@ class Tunnel(Killable):
     """An object representing a TCP proxy from localhost onto a container.
     Do not instantiate directly, use location.tunnel_onto or location.wait_http_200.
 
-    Interact with the proxy through TCP (or call localport if you didn't set it explicitly).
+    Interact with the proxy through TCP (or call localport if you didn't set it explicitly),
+    or through a unix domain socket if the tunnel was created with a path.
     Note that apparently plaintext traffic through the tunnel is still encrypted on the wire."""
+    warm_expiry = 30  # seconds before an unused pre-warmed connection is replaced
 
-    def __init__(self, connection, node, container, port, lp=None, bind=None, timeout=30):
+    def __init__(self, connection, node, container, port, lp=None, bind=None, timeout=30, buffer=None, prewarm=0,
+                 path=None):
         super().__init__()
         # tell the location what we want
         self.uuid = shortuuid.uuid().encode()
@@ -42,11 +51,29 @@ class Tunnel(Killable):
         self.port = port
         self.lp = lp  # can be None
         self.bind = bind  # can be None
+        self.path = path  # listen on a unix domain socket instead, can be None
         self.fd = None
         self.tcpip_direct_return = None
         self.timeout = timeout
-        self.proxies = {}
+        self.proxies = {}  # proxy id -> Proxy
+        self.fd_proxies = {}  # local fd -> Proxy
+        self.prewarm = prewarm
+        self.warm = deque()  # proxies open on the far end but not yet connected locally
+        self.next_warm_id = Proxy.warm_ids
+        self.buffer = buffer  # re-used for every read from every proxy, can be shared between tunnels on a loop
+        self.buffer_view = None
+        self.window = None  # flow control is off until the location advertises a window
         self.created = False
+
+        # metrics, these are just counters so are cheap enough to leave on
+        self.bytes_in = 0  # from the container
+        self.bytes_out = 0  # to the container
+        self.messages_in = 0
+        self.messages_out = 0
+        self.connections = 0
+        self.errors = 0
+        self.connect_latency_total = 0.0
+        self.connect_latency_count = 0
         connection.register_connect_callback(self._session_reconnected)
 
     def connect(self):
@@ -55,12 +82,33 @@ class Tunnel(Killable):
         if self.created:
             return
         self.created = True
+        if self.buffer is None:
+            self.buffer = bytearray(Proxy.max_read)
+        self.buffer_view = memoryview(self.buffer)
+
         # create the listen socket
-        self.socket = socket.socket()
-        self.socket.setblocking(False)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind(('0.0.0.0' if self.bind is None else self.bind, 0 if self.lp is None else self.lp))
-        self.lp = self.socket.getsockname()[1]
+        if self.path is None:
+            self.socket = socket.socket()
+            self.socket.setblocking(False)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(('0.0.0.0' if self.bind is None else self.bind, 0 if self.lp is None else self.lp))
+            self.lp = self.socket.getsockname()[1]
+        else:
+            # a socket left over from a previous run would stop us binding, but don't take over a live one
+            if os.path.exists(self.path) and stat.S_ISSOCK(os.stat(self.path).st_mode):
+                probe = socket.socket(socket.AF_UNIX)
+                try:
+                    probe.connect(self.path)
+                except ConnectionRefusedError:
+                    os.unlink(self.path)  # nothing listening
+                else:
+                    raise OSError(errno.EADDRINUSE, "Socket is already being listened on", self.path)
+                finally:
+                    probe.close()
+            self.socket = socket.socket(socket.AF_UNIX)
+            self.socket.setblocking(False)
+            self.socket.bind(self.path)
+            self.lp = None
         self.socket.listen()
         self.fd = self.socket.fileno()
         self.connection().loop.register_exclusive(self.fd, self.event, comment="listener for " + str(self))
@@ -69,8 +117,15 @@ class Tunnel(Killable):
         self.connection().send_cmd(b'create_tunnel',
                                    {'container': self.container().uuid,
                                     'port': self.port,
-                                    'timeout': self.timeout}, uuid=self.uuid)
-        logging.info("Creating remote tunnel: %s (%d -> %d)" % (self.uuid.decode(), self.lp, self.port))
+                                    'timeout': self.timeout,
+                                    'window': Proxy.window}, uuid=self.uuid)
+        logging.info("Creating remote tunnel: %s (%s -> %d)" %
+                     (self.uuid.decode(), self.path if self.lp is None else str(self.lp), self.port))
+
+        # pre-warm connections
+        if self.prewarm != 0:
+            self.fill_warm()
+            self.connection().loop.register_on_idle(self._expire_warm)
 
     def connect_tcpip_direct(self, caller):
         self.ensure_alive()
@@ -96,83 +151,190 @@ class Tunnel(Killable):
         else:
             self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
                                                      "proxy": 0}, bulk=data)
+            self.bytes_out += len(data)
+            self.messages_out += 1
 
-    def localport(self) -> int:
+    def localport(self) -> Optional[int]:
         """Returns the (possibly dynamically allocated) local port number.
 
-        :return: the port number as an int"""
+        :return: the port number as an int, or None if the tunnel is on a unix domain socket"""
         self.ensure_alive()
         return self.lp
 
+    def localpath(self) -> Optional[str]:
+        """Returns the path of the unix domain socket.
+
+        :return: the path, or None if the tunnel is on a TCP port"""
+        self.ensure_alive()
+        return self.path
+
     def destroy(self, with_command=True):
         # Destroy this tunnel.
         if self.bail_if_dead():
             return
         self.mark_as_dead()
         self.connection().unregister_connect_callback(self._session_reconnected)
+        self.connection().loop.unregister_on_idle(self._expire_warm)
         self.disconnect_all_proxies()
         if self.fd is not None:
             self.connection().loop.unregister_exclusive(self.fd)
         if self.socket is not None:
             self.socket.close()
+            if self.path is not None:
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
         if with_command:
             self.connection().send_cmd(b'destroy_tunnel', {"tunnel": self.uuid})
         logging.info("Destroyed remote tunnel: " + self.uuid.decode())
 
     def disconnect_all_proxies(self):
         # when the container reboots we need to close the tcp connections
-        for proxy in list(self.proxies.items()):
-            self.connection().loop.unregister_exclusive(proxy[0])
-            proxy[1].close()
+        for fd in list(self.fd_proxies.keys()):
+            self.connection().loop.unregister_exclusive(fd)
+        for proxy in self.proxies.values():
+            proxy.close()
         self.proxies.clear()
+        self.fd_proxies.clear()
+        self.warm.clear()
 
     def event(self, localfd):
-        # An event on the connection itself
-        # The accept call sometimes fails
+        # An event on the listening socket, accept every connection that is waiting
+        # and return as soon as there are none (never block the message loop)
         if self.bail_if_dead():
             return
-        new_proxy = None
-        while new_proxy is None:
+        while True:
             try:
-                new_proxy = self.socket.accept()
-            except BlockingIOError:
-                logging.debug("Attempting to accept a new connection but the resource was temporarily unavailable")
-                time.sleep(0.1)
+                skt, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.warning("Failed to accept a connection for tunnel %s: %s" % (self.uuid.decode(), str(e)))
+                self.errors += 1
+                return
+            self.add_proxy(skt)
 
-        fd = new_proxy[0].fileno()
-        self.proxies[fd] = new_proxy[0]
-        self.connection().loop.register_exclusive(fd, self.to_proxy, comment="proxy fd=" + str(fd))
+    def add_proxy(self, skt):
+        skt.setblocking(False)
+        fd = skt.fileno()
 
-        # send nothing to force the connection open on the far end - some servers like to talk first
-        self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
-                                                 "proxy": fd}, bulk=b'')
+        # use a pre-warmed connection if we can
+        if len(self.warm) != 0:
+            proxy = self.warm.popleft()
+            proxy.attach(skt)
+            if proxy.queued != 0:  # the far end talked first and it's already here
+                self.record_connect_latency(proxy)
+            logging.debug("Accepted proxy connection onto warm proxy %d, fd: %d" % (proxy.id, fd))
+        else:
+            proxy = Proxy(fd, skt, self.window)
+            self.proxies[proxy.id] = proxy
 
-        logging.debug("Accepted proxy connection, fd: " + str(fd))
+            # send nothing to force the connection open on the far end - some servers like to talk first
+            self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
+                                                     "proxy": proxy.id}, bulk=b'')
+            logging.debug("Accepted proxy connection, fd: " + str(fd))
 
-    def to_proxy(self, localfd):
-        # Send to the location which will forward to the end client.
+        self.fd_proxies[fd] = proxy
+        self.connections += 1
+        self.connection().loop.register_exclusive(fd, self.proxy_event, comment="proxy fd=" + str(fd))
+        if proxy.queued != 0:  # the far end already talked to the warm proxy
+            self.update_polling(proxy)
+        self.fill_warm()
+
+    def fill_warm(self):
+        # open connections on the far end ahead of them being needed
+        while len(self.warm) < self.prewarm:
+            proxy = Proxy(self.next_warm_id, None, self.window)
+            self.next_warm_id += 1
+            self.proxies[proxy.id] = proxy
+            self.warm.append(proxy)
+            self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
+                                                     "proxy": proxy.id}, bulk=b'')
+
+    def _expire_warm(self):
+        # warm connections that have been idle too long are closed and replaced
+        expire_before = time.time() - self.warm_expiry
+        while len(self.warm) != 0 and self.warm[0].created < expire_before:
+            proxy = self.warm.popleft()
+            del self.proxies[proxy.id]
+            self.connection().send_cmd(b'close_proxy', {"tunnel": self.uuid,
+                                                        "proxy": proxy.id})
+        self.fill_warm()
+
+    def proxy_event(self, localfd):
+        # The local end of a proxy is readable and/or writable
         if self.bail_if_dead():
             return
         try:
-            data = b''
-            try:
-                data = self.proxies[localfd].recv(8192)
-            except ConnectionResetError:
-                logging.debug("Connection reset when receiving from proxy")
-                pass
-            if data == b'':
-                logging.debug("Received no data, assuming socket was closed for proxy: " + str(localfd))
-                self.close_proxy(localfd)
-                self.connection().send_cmd(b'close_proxy', {"tunnel": self.uuid,
-                                                            "proxy": localfd})
-            else:
-                logging.debug("Sending data to proxy: " + str(localfd))
-                self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
-                                                         "proxy": localfd}, bulk=data)
+            proxy = self.fd_proxies[localfd]
         except KeyError:
-            logging.debug("Received a forwarding request to a proxy not in map: " + str(localfd))
+            logging.debug("Received an event for a proxy not in map: " + str(localfd))
+            return
+
+        # write anything that was queued
+        if proxy.queued != 0:
+            try:
+                proxy.flush()
+            except OSError:
+                proxy.errors += 1
+                self.errors += 1
+                self.local_close(proxy)
+                return
+            if proxy.closing and proxy.queued == 0:
+                self.close_proxy(proxy.id)
+                return
+            self.update_polling(proxy)
+
+        # then read
+        self.to_proxy(proxy)
 
-        return True  # everything went fine
+    def update_polling(self, proxy):
+        # poll for writable while there's a queue, stop reading when we have run out of credit to send
+        # to the location
+        paused = proxy.paused
+        proxy.update_watermarks()
+        if paused and not proxy.paused:
+            self.acknowledge(proxy, 0)  # drained below the low watermark, release the withheld acknowledgements
+        if proxy.fd is None:
+            return  # warm, not connected locally yet
+        reading = proxy.credit is None or proxy.credit > 0
+        flags = (zmq.POLLIN if reading else 0) | (zmq.POLLOUT if proxy.queued != 0 else 0)
+        if flags != proxy.flags:
+            proxy.flags = flags
+            self.connection().loop.p.register(proxy.fd, flags)
+
+    def to_proxy(self, proxy):
+        # Send to the location which will forward to the end client.
+        # Drains as much as is ready (up to a cap) into a single message, no logging on the data path.
+        # only read as much as we have credit for
+        view = self.buffer_view if proxy.credit is None else self.buffer_view[:min(proxy.credit, len(self.buffer))]
+        if len(view) == 0:
+            self.update_polling(proxy)
+            return
+        errors = proxy.errors
+        length, closed = proxy.drain(view)
+        if length != 0:
+            self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
+                                                     "proxy": proxy.id}, bulk=bytes(self.buffer_view[:length]))
+            proxy.bytes_out += length
+            proxy.messages_out += 1
+            self.bytes_out += length
+            self.messages_out += 1
+            if proxy.credit is not None:
+                proxy.credit -= length
+                if proxy.credit == 0:
+                    self.update_polling(proxy)
+        if closed:
+            logging.debug("Received no data, assuming socket was closed for proxy: " + str(proxy.id))
+            self.errors += proxy.errors - errors
+            self.local_close(proxy)
+
+    def local_close(self, proxy):
+        # the local end closed or failed so close, then tell the location
+        self.close_proxy(proxy.id)
+        self.connection().send_cmd(b'close_proxy', {"tunnel": self.uuid,
+                                                    "proxy": proxy.id})
 
     def from_proxy(self, msg):
         # Data being sent from the container
@@ -181,29 +343,89 @@ class Tunnel(Killable):
 
         # is this a tcpip_direct tunnel?
         if self.tcpip_direct_return is not None:
+            self.bytes_in += len(msg.bulk)
+            self.messages_in += 1
             self.tcpip_direct_return.data(self, msg.bulk)
             return
 
         # headed for a tcp proxy as usual
         try:
-            proxy_fd = msg.params['proxy']
+            proxy_id = msg.params['proxy']
         except KeyError:
             # a blank message with no proxy id is to let us know it constructed server side
             logging.debug("From proxy message with no proxy, marking tunnel as ready: " + self.uuid.decode())
             return
 
         if msg.command == 'close_proxy':
-            logging.debug("Server told us to close connection: " + str(proxy_fd))
-            self.close_proxy(proxy_fd)
+            logging.debug("Server told us to close connection: " + str(proxy_id))
+            self.close_proxy(proxy_id)
+            return
+
+        try:
+            proxy = self.proxies[proxy_id]
+        except KeyError:
+            return  # proxy has already gone away
+
+        # how long did it take the far end to connect?
+        length = len(msg.bulk)
+        if proxy.connect_latency is None and proxy.connected is not None:
+            self.record_connect_latency(proxy)
+        proxy.bytes_in += length
+        proxy.messages_in += 1
+        self.bytes_in += length
+        self.messages_in += 1
+
+        # send what we can without blocking the message loop, queue the rest
+        try:
+            proxy.write(msg.bulk)
+        except OSError:
+            proxy.errors += 1
+            self.errors += 1
+            self.local_close(proxy)
             return
+        self.update_polling(proxy)
+        self.acknowledge(proxy, length)
 
+    def record_connect_latency(self, proxy):
+        # from the local connection being accepted to the first data from the container
+        proxy.connect_latency = time.time() - proxy.connected
+        self.connect_latency_total += proxy.connect_latency
+        self.connect_latency_count += 1
+
+    def enable_flow_control(self, window):
+        # the location has agreed to credit based flow control (with a tunnel_window message)
+        logging.debug("Flow control window (%d bytes) for tunnel: %s" % (window, self.uuid.decode()))
+        self.window = window
+        for proxy in self.proxies.values():
+            proxy.credit = window
+
+    def ack_proxy(self, msg):
+        # the location has passed data on to the container, so we can send more
         try:
-            skt = self.proxies[proxy_fd]
-            skt.sendall(msg.bulk)
+            proxy = self.proxies[msg.params['proxy']]
         except KeyError:
-            pass  # proxy has already gone away
+            return  # proxy has already gone away
+        if proxy.credit is None:
+            return
+        proxy.credit += msg.params['bytes']
+        self.update_polling(proxy)
+
+    def acknowledge(self, proxy, accepted):
+        # tell the location we have taken data for the local client, in batches of a quarter window.
+        # Acknowledgements are withheld while the queue is over the high watermark so the location runs
+        # out of credit and stops sending. Without a window nothing bounds the queue.
+        if self.window is None:
+            return
+        proxy.unacked += accepted
+        if proxy.paused:
+            return
+        if proxy.unacked >= self.window // 4:
+            unacked, proxy.unacked = proxy.unacked, 0
+            self.connection().send_cmd(b'ack_proxy', {"tunnel": self.uuid,
+                                                      "proxy": proxy.id,
+                                                      "bytes": unacked})
 
-    def close_proxy(self, msg_or_fd):
+    def close_proxy(self, msg_or_id):
         if self.bail_if_dead():
             return
 
@@ -216,15 +438,49 @@ class Tunnel(Killable):
         # Close one single proxy
         try:
             try:
-                fd = msg_or_fd.params['proxy']
+                proxy_id = msg_or_id.params['proxy']
+
+                # closed by the location, but don't lose anything still queued for the local client
+                if self.proxies[proxy_id].queued != 0 and self.proxies[proxy_id].fd is not None:
+                    self.proxies[proxy_id].closing = True
+                    return
             except AttributeError:
-                fd = msg_or_fd  # when we close the proxy locally we will have been passed a file desriptor
-            self.proxies[fd].close()
-            self.connection().loop.unregister_exclusive(fd)
-            del self.proxies[fd]
-            logging.debug("Closed proxy connection, fd: " + str(fd))
+                proxy_id = msg_or_id  # when we close the proxy locally we will have been passed the id
+            proxy = self.proxies[proxy_id]
+            del self.proxies[proxy_id]
         except KeyError:
-            pass  # proxy has already gone away
+            return  # proxy has already gone away
+
+        # a warm proxy the far end gave up on?
+        if proxy.fd is None:
+            self.warm.remove(proxy)
+            logging.debug("Warm proxy was closed by the far end: " + str(proxy_id))
+            return
+
+        proxy.close()
+        self.connection().loop.unregister_exclusive(proxy.fd)
+        del self.fd_proxies[proxy.fd]
+        logging.debug("Closed proxy connection, fd: " + str(proxy.fd))
+
+    def stats(self) -> dict:
+        """Returns traffic metrics for this tunnel.
+
+        :return: A dictionary of counters, with per-proxy counters for the currently open proxies under 'proxies'.
+
+        bytes_in and messages_in are from the container, bytes_out and messages_out are to the container.
+        connect_latency is the mean time (in seconds) from accepting a local connection to the first data from the
+        container - zero for a pre-warmed proxy the container had already sent to."""
+        return {'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'messages_in': self.messages_in,
+                'messages_out': self.messages_out,
+                'connections': self.connections,
+                'active': len(self.fd_proxies),
+                'warm': len(self.warm),
+                'errors': self.errors,
+                'connect_latency': self.connect_latency_total / self.connect_latency_count
+                if self.connect_latency_count != 0 else None,
+                'proxies': {proxy.id: proxy.stats() for proxy in list(self.fd_proxies.values())}}
 
     def _session_reconnected(self, rid):
         logging.debug("Tunnel reset its session id: " + self.uuid.decode())
@@ -233,3 +489,439 @@ class Tunnel(Killable):
     def __repr__(self):
         return "<Tunnel '%s' localport=%d container=%s)>" % \
                (self.uuid.decode(), self.port, self.container().uuid.decode())
+
+
+class Proxy:
+    """A single TCP connection through a tunnel. Do not instantiate directly."""
+    min_read = 8192
+    max_read = 1024 * 1024  # also the largest message we will send
+    high_watermark = 4 * 1024 * 1024  # queued for the local client, stop acknowledging the location over this
+    low_watermark = 1024 * 1024  # ...and start again under this
+    window = 2 * 1024 * 1024  # the flow control window we ask for
+    warm_ids = 1 << 24  # pre-warmed proxies are identified from here up, so they can't clash with fd's
+
+    def __init__(self, proxy_id, skt, window=None):
+        self.id = proxy_id
+        self.socket = skt
+        self.fd = skt.fileno() if skt is not None else None
+        self.created = time.time()
+        self.connected = self.created if skt is not None else None  # when the local client connected
+        self.read_size = Proxy.min_read
+        self.credit = window  # bytes we can send before being acknowledged, None if not flow controlled
+        self.unacked = 0  # bytes accepted for the local client that the location doesn't know about yet
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.errors = 0
+        self.connect_latency = None
+        self.outbound = deque()
+        self.queued = 0
+        self.paused = False  # over the high watermark, acknowledgements to the location are withheld
+        self.closing = False
+        self.flags = zmq.POLLIN
+
+    def write(self, data) -> int:
+        # Send without blocking, anything that can't be sent is queued to go when the socket is writable.
+        # Returns the number of bytes actually sent.
+        sent = 0
+        if len(self.outbound) == 0 and self.socket is not None:
+            try:
+                sent = self.socket.send(data)
+            except BlockingIOError:
+                pass
+            if sent == len(data):
+                return sent
+            data = memoryview(data)[sent:]
+        self.outbound.append(data)
+        self.queued += len(data)
+        return sent
+
+    def flush(self) -> int:
+        total = 0
+        while len(self.outbound) != 0:
+            data = self.outbound[0]
+            try:
+                sent = self.socket.send(data)
+            except BlockingIOError:
+                break
+            self.queued -= sent
+            total += sent
+            if sent != len(data):
+                self.outbound[0] = memoryview(data)[sent:]
+                break
+            self.outbound.popleft()
+        return total
+
+    def attach(self, skt):
+        # a local connection for a pre-warmed proxy
+        self.socket = skt
+        self.fd = skt.fileno()
+        self.connected = time.time()
+        self.flags = zmq.POLLIN
+
+    def stats(self) -> dict:
+        return {'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'messages_in': self.messages_in,
+                'messages_out': self.messages_out,
+                'queued': self.queued,
+                'errors': self.errors,
+                'connect_latency': self.connect_latency}
+
+    def update_watermarks(self):
+        if self.queued > Proxy.high_watermark:
+            self.paused = True
+        elif self.queued < Proxy.low_watermark:
+            self.paused = False
+
+    def drain(self, buffer) -> (int, bool):
+        # Reads whatever is ready into the buffer, the read size grows while reads keep filling it.
+        # Returns the number of bytes read and whether or not the socket was closed.
+        view = memoryview(buffer)
+        length = 0
+        while length < len(buffer):
+            want = min(self.read_size, len(buffer) - length)
+            try:
+                received = self.socket.recv_into(view[length:length + want], want, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                logging.debug("Connection reset when receiving from proxy")
+                self.errors += 1
+                return length, True
+            if received == 0:
+                return length, True
+            length += received
+
+            # adapt
+            if received == want:
+                self.read_size = min(self.read_size * 2, Proxy.max_read)
+            else:
+                if received < self.read_size // 4:
+                    self.read_size = max(self.read_size // 2, Proxy.min_read)
+                break  # a short read means there's nothing left
+        return length, False
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+
+class UdpTunnel(Tunnel):
+    """An object representing a UDP proxy from localhost onto a container.
+    Do not instantiate directly, use container.attach_udp_tunnel.
+
+    Each local peer (address, port) gets a session, and each session has its own socket on the far end
+    so replies find their way back to the right peer. Datagrams are neither queued nor flow controlled:
+    if the local socket can't take a reply it is dropped, as it would be on any other congested UDP path."""
+    session_expiry = 60  # seconds of silence before a session is forgotten
+
+    def __init__(self, connection, node, container, port, lp=None, bind=None, timeout=30, buffer=None):
+        super().__init__(connection, node, container, port, lp, bind, timeout, buffer)
+        self.peers = {}  # (address, port) -> UdpSession
+        self.next_session_id = 1
+        self.dropped = 0
+
+    def connect(self):
+        self.ensure_alive()
+        if self.created:
+            return
+        self.created = True
+        if self.buffer is None:
+            self.buffer = bytearray(Proxy.max_read)
+        self.buffer_view = memoryview(self.buffer)
+
+        # create the local socket
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('0.0.0.0' if self.bind is None else self.bind, 0 if self.lp is None else self.lp))
+        self.lp = self.socket.getsockname()[1]
+        self.fd = self.socket.fileno()
+        self.connection().loop.register_exclusive(self.fd, self.event, comment="udp socket for " + str(self))
+        self.connection().loop.register_on_idle(self._expire_sessions)
+
+        # have the location create its end.
+        self.connection().send_cmd(b'create_tunnel',
+                                   {'container': self.container().uuid,
+                                    'port': self.port,
+                                    'timeout': self.timeout,
+                                    'protocol': 'udp'}, uuid=self.uuid)
+        logging.info("Creating remote udp tunnel: %s (%d -> %d)" % (self.uuid.decode(), self.lp, self.port))
+
+    def destroy(self, with_command=True):
+        if self.bail_if_dead():
+            return
+        self.connection().loop.unregister_on_idle(self._expire_sessions)
+        super().destroy(with_command)
+
+    def disconnect_all_proxies(self):
+        super().disconnect_all_proxies()
+        self.peers.clear()
+
+    def event(self, localfd):
+        # Datagrams from local peers, each is forwarded as a single message so boundaries are kept
+        if self.bail_if_dead():
+            return
+        while True:
+            try:
+                length, peer = self.socket.recvfrom_into(self.buffer_view, 65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logging.debug("Failed to receive a datagram for tunnel %s: %s" % (self.uuid.decode(), str(e)))
+                self.errors += 1
+                return
+            if length == 0:
+                continue  # an empty message would be taken to mean 'open a connection'
+
+            try:
+                session = self.peers[peer]
+            except KeyError:
+                session = UdpSession(self.next_session_id, peer)
+                self.next_session_id += 1
+                self.proxies[session.id] = session
+                self.peers[peer] = session
+                self.connections += 1
+                logging.debug("New udp session %d for: %s" % (session.id, str(peer)))
+
+            session.last_used = time.time()
+            self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
+                                                     "proxy": session.id}, bulk=bytes(self.buffer_view[:length]))
+            session.bytes_out += length
+            session.messages_out += 1
+            self.bytes_out += length
+            self.messages_out += 1
+
+    def from_proxy(self, msg):
+        # A datagram from the container, to be sent to whichever peer owns the session
+        if self.bail_if_dead():
+            return
+        try:
+            session = self.proxies[msg.params['proxy']]
+        except KeyError:
+            return  # the ready message, or a session we have already forgotten
+
+        length = len(msg.bulk)
+        if session.connect_latency is None:
+            session.connect_latency = time.time() - session.created
+            self.connect_latency_total += session.connect_latency
+            self.connect_latency_count += 1
+        session.last_used = time.time()
+        session.bytes_in += length
+        session.messages_in += 1
+        self.bytes_in += length
+        self.messages_in += 1
+        try:
+            self.socket.sendto(msg.bulk, session.peer)
+        except BlockingIOError:
+            self.dropped += 1
+        except OSError:
+            session.errors += 1
+            self.errors += 1
+
+    def ack_proxy(self, msg):
+        pass  # not flow controlled
+
+    def close_proxy(self, msg_or_id):
+        # the location has given up on a session (or we have), the next datagram from the peer starts another
+        if self.bail_if_dead():
+            return
+        try:
+            session_id = msg_or_id.params['proxy']
+        except AttributeError:
+            session_id = msg_or_id
+        try:
+            session = self.proxies.pop(session_id)
+        except KeyError:
+            return
+        del self.peers[session.peer]
+        logging.debug("Closed udp session: " + str(session_id))
+
+    def _expire_sessions(self):
+        expire_before = time.time() - self.session_expiry
+        for session in [s for s in self.peers.values() if s.last_used < expire_before]:
+            self.close_proxy(session.id)
+            self.connection().send_cmd(b'close_proxy', {"tunnel": self.uuid,
+                                                        "proxy": session.id})
+
+    def stats(self) -> dict:
+        """Returns traffic metrics for this tunnel.
+
+        :return: A dictionary of counters as for a TCP tunnel, with per-session counters under 'proxies'.
+
+        'dropped' counts replies that could not be passed to the local socket."""
+        stats = super().stats()
+        stats['active'] = len(self.peers)
+        stats['dropped'] = self.dropped
+        stats['proxies'] = {session.id: session.stats() for session in list(self.peers.values())}
+        return stats
+
+    def __repr__(self):
+        return "<UdpTunnel '%s' localport=%d container=%s)>" % \
+               (self.uuid.decode(), self.port, self.container().uuid.decode())
+
+
+class UdpSession:
+    """The datagrams from a single local peer through a udp tunnel. Do not instantiate directly."""
+
+    def __init__(self, session_id, peer):
+        self.id = session_id
+        self.peer = peer
+        self.created = time.time()
+        self.last_used = self.created
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.errors = 0
+        self.connect_latency = None
+
+    def stats(self) -> dict:
+        return {'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'messages_in': self.messages_in,
+                'messages_out': self.messages_out,
+                'errors': self.errors,
+                'connect_latency': self.connect_latency}
+
+    def close(self):
+        pass
+
+
+class ReverseTunnel(Tunnel):
+    """A port listened on inside a container, each connection it accepts is handed to the caller.
+    Do not instantiate directly, the ssh server uses these for remote forwards (ssh -R).
+
+    The location allocates the proxy id's: the first message for an id we don't know is a new connection.
+    Like a tcpip direct tunnel, it is not flow controlled."""
+
+    def __init__(self, connection, node, container, port, caller):
+        super().__init__(connection, node, container, port)
+        self.reverse_return = caller
+
+    def connect(self):
+        # blocks so the caller knows whether or not the location could listen - raises ValueError if not
+        self.ensure_alive()
+        if self.created:
+            return
+        self.created = True
+        self.connection().send_blocking_cmd(b'create_reverse_tunnel', {'tunnel': self.uuid,
+                                                                       'container': self.container().uuid,
+                                                                       'port': self.port})
+        logging.info("Created remote reverse tunnel: %s (port %d)" % (self.uuid.decode(), self.port))
+
+    def from_proxy(self, msg):
+        # Data from a connection inside the container, or a new connection
+        if self.bail_if_dead():
+            return
+        try:
+            proxy_id = msg.params['proxy']
+        except KeyError:
+            return  # the ready message
+
+        try:
+            proxy = self.proxies[proxy_id]
+        except KeyError:
+            proxy = ReverseProxy(self, proxy_id)
+            self.proxies[proxy_id] = proxy
+            self.connections += 1
+            logging.debug("Reverse tunnel %s accepted connection: %d" % (self.uuid.decode(), proxy_id))
+            if not self.reverse_return.reverse_accepted(proxy):
+                self.errors += 1
+                self.local_close(proxy)
+                return
+
+        length = len(msg.bulk)
+        if length == 0:
+            return
+        proxy.bytes_in += length
+        proxy.messages_in += 1
+        self.bytes_in += length
+        self.messages_in += 1
+        proxy.data_callback(proxy, msg.bulk)
+
+    def forward(self, proxy, data):
+        # Data for a connection inside the container
+        self.connection().send_cmd(b'to_proxy', {"tunnel": self.uuid,
+                                                 "proxy": proxy.id}, bulk=data)
+        proxy.bytes_out += len(data)
+        proxy.messages_out += 1
+        self.bytes_out += len(data)
+        self.messages_out += 1
+
+    def ack_proxy(self, msg):
+        pass  # not flow controlled
+
+    def close_proxy(self, msg_or_id):
+        # the connection inside the container closed (or we closed it)
+        if self.bail_if_dead():
+            return
+        try:
+            proxy_id = msg_or_id.params['proxy']
+        except AttributeError:
+            proxy_id = msg_or_id
+        try:
+            proxy = self.proxies.pop(proxy_id)
+        except KeyError:
+            return
+        proxy.close()
+        logging.debug("Closed reverse connection: " + str(proxy_id))
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['active'] = len(self.proxies)
+        stats['proxies'] = {proxy.id: proxy.stats() for proxy in list(self.proxies.values())}
+        return stats
+
+    def __repr__(self):
+        return "<ReverseTunnel '%s' port=%d container=%s)>" % \
+               (self.uuid.decode(), self.port, self.container().uuid.decode())
+
+
+class ReverseProxy:
+    """A single connection accepted by a reverse tunnel. Do not instantiate directly.
+    Looks enough like a process for the ssh server to put it on the end of a channel."""
+
+    def __init__(self, tunnel, proxy_id):
+        self.tunnel = weakref.ref(tunnel)
+        self.id = proxy_id
+        self.uuid = tunnel.uuid + b'/' + str(proxy_id).encode()
+        self.dead = False
+        self.data_callback = None
+        self.termination_callback = None
+        self.created = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.messages_in = 0
+        self.messages_out = 0
+
+    def stdin(self, data):
+        if self.dead:
+            return
+        if len(data) == 0:
+            self.destroy()
+            return
+        self.tunnel().forward(self, data)
+
+    def destroy(self):
+        # closed from our end
+        if self.dead:
+            return
+        self.dead = True
+        self.tunnel().local_close(self)
+
+    def close(self):
+        # closed from the container's end, or the tunnel is going away
+        if self.dead:
+            return
+        self.dead = True
+        if self.termination_callback is not None:
+            self.termination_callback(self, 0)
+
+    def stats(self) -> dict:
+        return {'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'messages_in': self.messages_in,
+                'messages_out': self.messages_out}